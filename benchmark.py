@@ -0,0 +1,726 @@
+"""
+性能基准与回归对比脚本，每个子命令对应一项优化。
+
+用法示例：
+python benchmark.py tokenize --datapath data/fold_ --prompt_id 1
+python benchmark.py tokenizer --datapath data/fold_
+python benchmark.py padding --num_essays 10000
+python benchmark.py model --batch_sizes 10 32 64 128 256
+python benchmark.py masked --datapath data/fold_ --prompt_id 1
+python benchmark.py dtype --batch_sizes 10 64 256
+python benchmark.py export --batch_sizes 1 8 64
+python benchmark.py threads --num_threads 1 2 4
+python benchmark.py sparse --vocab_sizes 4000 50000 400000
+python benchmark.py checkpoint --batch_sizes 10 32 64 --memory_budget 2048
+python benchmark.py loader --num_essays 1400 --epochs 3
+"""
+import argparse
+import difflib
+import json
+import os
+import subprocess
+import tempfile
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import reader
+import utils
+
+# 初始化日志记录器
+logger = utils.get_logger("Benchmark ...")
+
+
+def fold_paths(datapath, num_folds=5, names=('train', 'dev', 'test')):
+    """返回各折数据文件的路径列表"""
+    return [datapath + str(fold) + '/' + name + '.tsv' for fold in range(num_folds) for name in names]
+
+
+def legacy_text_tokenizer(content, create_vocab_flag=False):
+    """旧的标记化流程：整篇标记化后拼回字符串，再逐句重新调用nltk"""
+    tokens = reader.tokenize(reader.clean_text(content))
+    return reader.tokenize_to_sentences(" ".join(tokens), reader.MAX_SENTLEN, create_vocab_flag)
+
+
+def bench_tokenize(args):
+    """
+    对比单次标记化流程（train.py --single_pass_tokenize）与默认流程的输出和耗时，输出不一致时返回非零。
+    两者在句号与引号或缩写相连的句子上可能不同（见reader.split_pretokenized），输出不一致的作文比例；
+    只有在实际数据上没有差异时才应启用单次流程。
+    """
+    reader.set_single_pass_tokenization(True)
+    mismatches, total = 0, 0
+    legacy_time, new_time = 0., 0.
+    for file_path in fold_paths(args.datapath, args.num_folds):
+        rows = reader.read_tsv_rows(file_path, args.prompt_id)
+        for create_vocab_flag in (False, True):
+            for _, _, content, _ in rows:
+                start = time.time()
+                expected = legacy_text_tokenizer(content, create_vocab_flag)
+                legacy_time += time.time() - start
+                start = time.time()
+                actual = reader.text_tokenizer(content, create_vocab_flag=create_vocab_flag)
+                new_time += time.time() - start
+                total += 1
+                if actual != expected:
+                    mismatches += 1
+                    if mismatches <= args.show:
+                        logger.info('Mismatch in %s (create_vocab_flag=%s):\n  legacy: %s\n  new:    %s'
+                                    % (file_path, create_vocab_flag, expected, actual))
+    logger.info('%d essays, %d mismatches (%.2f%%)' % (total, mismatches, 100. * mismatches / max(total, 1)))
+    logger.info('legacy: %.2fs, single pass: %.2fs, speedup: %.2fx' % (legacy_time, new_time, legacy_time / new_time))
+    return 1 if mismatches else 0
+
+
+# 单句Treebank规则的回归用例：引号、括号与's等缩写相邻时规则的顺序会影响结果
+TREEBANK_CASES = [
+    "e's'", "cand's'(", "he's' (here)", "it's' [sic]", "can't' --", "'tis' *", "we'll' <b>",
+    'said "hi." (twice)', "the '90s' -- ok", "don't' ?", "(it's')", "o'clock'{",
+]
+
+
+def check_treebank_cases():
+    """逐句比较fast_tokenizer与NLTKWordTokenizer在TREEBANK_CASES上的结果（不经过分句），返回不一致的用例数"""
+    from nltk.tokenize.destructive import NLTKWordTokenizer
+    import fast_tokenizer
+    tokenizer = NLTKWordTokenizer()
+    failed = 0
+    for case in TREEBANK_CASES:
+        expected, actual = tokenizer.tokenize(case), fast_tokenizer.treebank_tokenize(case)
+        if expected != actual:
+            failed += 1
+            logger.info('Treebank case %r: nltk %s, regex %s' % (case, expected, actual))
+    logger.info('Treebank cases: %d of %d differ' % (failed, len(TREEBANK_CASES)))
+    return failed
+
+
+def bench_tokenizer(args):
+    """对比regex分词后端与nltk的分词结果和耗时，输出不一致的切分统计；单句Treebank回归用例不一致时返回非零"""
+    failed = check_treebank_cases()
+    contents = [reader.clean_text(content) for file_path in fold_paths(args.datapath, args.num_folds)
+                for _, _, content, _ in reader.read_tsv_rows(file_path, args.prompt_id)]
+    timings = {}
+    outputs = {}
+    for backend in reader.TOKENIZER_BACKENDS:
+        reader.set_tokenizer_backend(backend)
+        start = time.time()
+        outputs[backend] = reader.word_tokenize_batch(contents)
+        timings[backend] = time.time() - start
+
+    mismatched_essays, mismatched_tokens, total_tokens = 0, 0, 0
+    diffs = Counter()
+    for expected, actual in zip(outputs['nltk'], outputs['regex']):
+        total_tokens += len(expected)
+        if expected == actual:
+            continue
+        mismatched_essays += 1
+        matcher = difflib.SequenceMatcher(None, expected, actual, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                mismatched_tokens += max(i2 - i1, j2 - j1)
+                diffs[(' '.join(expected[i1:i2]), ' '.join(actual[j1:j2]))] += 1
+
+    logger.info('%d essays, %d tokens' % (len(contents), total_tokens))
+    logger.info('mismatched essays: %d (%.2f%%), mismatched tokens: %d (%.4f%%)'
+                % (mismatched_essays, 100. * mismatched_essays / max(len(contents), 1),
+                   mismatched_tokens, 100. * mismatched_tokens / max(total_tokens, 1)))
+    for (expected, actual), count in diffs.most_common(args.show):
+        logger.info('  %6d  nltk: %-30s regex: %s' % (count, expected, actual))
+    logger.info('nltk: %.2fs, regex: %.2fs, speedup: %.2fx'
+                % (timings['nltk'], timings['regex'], timings['nltk'] / timings['regex']))
+    return 1 if failed else 0
+
+
+def legacy_padding_sentence_sequences(index_sequences, scores, max_sentnum, max_sentlen):
+    """旧的逐元素填充实现，用于对比"""
+    X = np.empty([len(index_sequences), max_sentnum, max_sentlen], dtype=np.int32)
+    Y = np.empty([len(index_sequences), 1], dtype=np.float32)
+    mask = np.zeros([len(index_sequences), max_sentnum, max_sentlen])
+    for i in range(len(index_sequences)):
+        sequence_ids = index_sequences[i]
+        num = len(sequence_ids)
+        for j in range(num):
+            word_ids = sequence_ids[j]
+            length = len(word_ids)
+            for k in range(length):
+                X[i, j, k] = word_ids[k]
+            X[i, j, length:] = 0
+            mask[i, j, :length] = 1
+        X[i, num:, :] = 0
+        Y[i] = scores[i]
+    return X, Y, mask
+
+
+def random_essays(num_essays, max_sentnum, max_sentlen, vocab_size=4000, seed=123):
+    """生成随机长度的作文词索引，模拟read_dataset的输出"""
+    rng = np.random.RandomState(seed)
+    essays = []
+    for _ in range(num_essays):
+        sentnum = rng.randint(1, max_sentnum + 1)
+        essays.append([rng.randint(1, vocab_size, size=rng.randint(1, max_sentlen + 1)).tolist()
+                       for _ in range(sentnum)])
+    scores = rng.randint(0, 13, size=num_essays).tolist()
+    return essays, scores
+
+
+def bench_padding(args):
+    """对比向量化填充与旧的逐元素填充的耗时和结果"""
+    essays, scores = random_essays(args.num_essays, args.max_sentnum, args.max_sentlen)
+    start = time.time()
+    expected = legacy_padding_sentence_sequences(essays, scores, args.max_sentnum, args.max_sentlen)
+    legacy_time = time.time() - start
+    logger.info('legacy: %.3fs, X %d bytes, mask %d bytes' % (legacy_time, expected[0].nbytes, expected[2].nbytes))
+    for dtype, mask_dtype in [(np.int32, np.float64), (np.int32, np.bool_), (utils.id_dtype(4000), np.bool_)]:
+        start = time.time()
+        X, Y, mask = utils.padding_sentence_sequences(essays, scores, args.max_sentnum, args.max_sentlen,
+                                                      dtype=dtype, mask_dtype=mask_dtype)
+        elapsed = time.time() - start
+        assert (X == expected[0]).all() and (Y == expected[1]).all() and (mask == expected[2]).all()
+        logger.info('vectorized (%s, %s): %.3fs, speedup %.1fx, X %d bytes, mask %d bytes'
+                    % (np.dtype(dtype).name, np.dtype(mask_dtype).name, elapsed, legacy_time / elapsed,
+                       X.nbytes, mask.nbytes))
+    # 超出uint16范围的词索引必须报错，而不是静默回绕
+    assert utils.id_dtype(70000) == np.uint32
+    try:
+        utils.padding_sentence_sequences([[[1, 70000]]], [0], 1, 2, dtype=np.uint16)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('word ids >= 65536 were written to uint16')
+    return 0
+
+
+def legacy_hieratt_forward(model, input):
+    """旧的HierAttNet前向计算：逐个句子位置调用WordAttNet后拼接"""
+    outputs = []
+    input = input.permute(1, 0, 2)
+    for i in input:
+        output = model.word_att_net(i.permute(1, 0))
+        for j in range(output.size(0)):
+            word = i[j].argmax().item()
+            if word in model.connector_dict:
+                connector_category = model.connector_dict[word]
+                if connector_category in model.connector_weights:
+                    output[j] *= model.connector_weights[connector_category]
+        outputs.append(output)
+    return model.sent_att_net(torch.cat(outputs, dim=0))
+
+
+def build_model(args):
+    """构建随机初始化嵌入的HierAttNet，用于基准测试"""
+    from hierarchical_att_model import HierAttNet
+    torch.manual_seed(args.seed)
+    embed_table = np.random.RandomState(args.seed).uniform(-0.1, 0.1, [args.vocab_size, 50])
+    model = HierAttNet(100, 100, 10, embed_table, args.max_sentnum, args.max_sentlen, args.connector_dict)
+    model.load_connector_weights()
+    model.eval()
+    return model
+
+
+def random_batch(batch_size, max_sentnum, max_sentlen, vocab_size, seed=123):
+    """生成随机长度作文填充后的词索引张量"""
+    essays, _ = random_essays(batch_size, max_sentnum, max_sentlen, vocab_size, seed)
+    X, _, _ = utils.padding_sentence_sequences(essays, [0] * batch_size, max_sentnum, max_sentlen)
+    return torch.from_numpy(X.astype(np.int64))
+
+
+def time_forward(forward, model, input, repeats):
+    """返回每秒处理的作文数"""
+    with torch.no_grad():
+        forward(model, input)
+        start = time.time()
+        for _ in range(repeats):
+            forward(model, input)
+        elapsed = time.time() - start
+    return repeats * input.size(0) / elapsed
+
+
+def bench_model(args):
+    """对比批量前向计算与逐句前向计算的输出和CPU吞吐量（作文/秒）"""
+    torch.set_num_threads(args.threads) if args.threads > 0 else None
+    model = build_model(args)
+    failed = False
+    for batch_size in args.batch_sizes:
+        input = random_batch(batch_size, args.max_sentnum, args.max_sentlen, args.vocab_size)
+        with torch.no_grad():
+            expected = legacy_hieratt_forward(model, input)
+        legacy_rate = time_forward(legacy_hieratt_forward, model, input, args.repeats)
+        logger.info('batch %4d: legacy %8.1f essays/s' % (batch_size, legacy_rate))
+        for chunk_size in args.word_chunk_sizes:
+            model.word_chunk_size = chunk_size
+            with torch.no_grad():
+                actual = model(input)
+            diff = (expected - actual).abs().max().item()
+            failed |= not torch.allclose(expected, actual, rtol=0, atol=args.atol)
+            rate = time_forward(lambda m, x: m(x), model, input, args.repeats)
+            logger.info('  word_chunk_size %5s: batched %8.1f essays/s, speedup %.2fx, max abs diff %.3g'
+                        % (chunk_size or 'all', rate, rate / legacy_rate, diff))
+    return 1 if failed else 0
+
+
+def empty_sentence_check(model, essays, max_sentnum, max_sentlen):
+    """
+    回归检查：reader.shorten_tokens会在作文开头或中间产生空句子（如以He、It开头的超长句子）。
+    每篇作文取前3个句子并在前面插入一个空句子，检查masked模式下的句子数包含最后一个句子、输出随最后一个句子变化，
+    且静态形状（导出）与动态形状的输出一致。
+
+    :return: (句子数错误或最后一个句子不影响输出的作文数, 静态与动态形状输出的最大差异)
+    """
+    import copy
+    from hierarchical_att_model import essay_lengths
+    essays = [[[]] + essay[:min(3, max_sentnum - 1)] for essay in essays]
+    changed = [essay[:-1] + [[3] * len(essay[-1])] for essay in essays]
+    input, changed = [torch.from_numpy(utils.padding_sentence_sequences(batch, [0] * len(batch), max_sentnum,
+                                                                        max_sentlen, dtype=np.int64)[0])
+                      for batch in (essays, changed)]
+    lengths = essay_lengths(input.permute(1, 0, 2).reshape(-1, input.size(2)).ne(0).any(1), max_sentnum, len(essays))
+    static_model = copy.deepcopy(model)
+    static_model.static_shapes = True
+    with torch.no_grad():
+        output = model(input)
+        wrong = (lengths != torch.tensor([len(essay) for essay in essays])) | (output == model(changed)).view(-1)
+        diff = (output - static_model(input)).abs().max().item()
+    return int(wrong.sum()), diff
+
+
+def bench_masked(args):
+    """
+    对比忽略填充的前向计算与原前向计算的吞吐量，并检查忽略填充时的输出不受填充量影响。
+
+    给出--datapath时使用该折测试集的真实作文长度（填充到训练时的全局最大值），否则使用随机长度的作文。
+    """
+    model = build_model(args)
+    if args.datapath:
+        file_path = args.datapath + '0/test.tsv'
+        vocab = reader.create_vocab(file_path, args.prompt_id, args.vocab_size, True, True)
+        essays, _, _, _, _ = reader.read_dataset(file_path, args.prompt_id, vocab, True)
+    else:
+        essays, _ = random_essays(max(args.batch_sizes), args.max_sentnum, args.max_sentlen, args.vocab_size)
+    essays = [[sent[:args.max_sentlen] for sent in essay[:args.max_sentnum]] for essay in essays]
+    failed = False
+    for batch_size in args.batch_sizes:
+        batch = essays[:batch_size]
+        input = torch.from_numpy(utils.padding_sentence_sequences(batch, [0] * len(batch), args.max_sentnum,
+                                                                  args.max_sentlen, dtype=np.int64)[0])
+        model.masked = False
+        rate = time_forward(lambda m, x: m(x), model, input, args.repeats)
+        model.masked = True
+        masked_rate = time_forward(lambda m, x: m(x), model, input, args.repeats)
+        # 只填充到本批最大值时，忽略填充的输出应与填充到全局最大值时相同
+        sentnum = max(len(essay) for essay in batch)
+        sentlen = max(5, max(len(sent) for essay in batch for sent in essay))
+        trimmed = torch.from_numpy(utils.padding_sentence_sequences(batch, [0] * len(batch), sentnum, sentlen,
+                                                                    dtype=np.int64)[0])
+        with torch.no_grad():
+            diff = (model(input) - model(trimmed)).abs().max().item()
+        failed |= diff > args.atol
+        real = sum(len(sent) for essay in batch for sent in essay)
+        logger.info('batch %4d (%.1f%% real tokens): unmasked %8.1f essays/s, masked %8.1f essays/s, speedup %.2fx, '
+                    'padding invariance max abs diff %.3g'
+                    % (len(batch), 100. * real / input.numel(), rate, masked_rate, masked_rate / rate, diff))
+    ignored, static_diff = empty_sentence_check(model, essays[:max(args.batch_sizes)], args.max_sentnum,
+                                                args.max_sentlen)
+    failed |= ignored > 0 or static_diff > args.atol
+    logger.info('leading empty sentence: %d essays lose their last sentence, static shapes max abs diff %.3g'
+                % (ignored, static_diff))
+    logger.info('QWK: compare "python train.py ..." with and without --masked on the same folds')
+    return 1 if failed else 0
+
+
+def bench_dtype(args):
+    """对比float32与bfloat16混合精度前向计算的吞吐量和输出差异"""
+    model = build_model(args)
+    model.masked = args.masked
+    for batch_size in args.batch_sizes:
+        input = random_batch(batch_size, args.max_sentnum, args.max_sentlen, args.vocab_size)
+        model.autocast_dtype = None
+        with torch.no_grad():
+            expected = model(input)
+        rate = time_forward(lambda m, x: m(x), model, input, args.repeats)
+        model.autocast_dtype = torch.bfloat16
+        with torch.no_grad():
+            actual = model(input)
+        bf16_rate = time_forward(lambda m, x: m(x), model, input, args.repeats)
+        logger.info('batch %4d: float32 %8.1f essays/s, bfloat16 %8.1f essays/s, speedup %.2fx, max abs diff %.3g'
+                    % (batch_size, rate, bf16_rate, bf16_rate / rate, (expected - actual).abs().max().item()))
+    logger.info('QWK: compare "python train.py ..." with and without --bf16 on the same folds')
+    return 0
+
+
+def bench_export(args):
+    """对比原模型与导出的TorchScript模型在不同批大小下的延迟"""
+    import export
+    import inference
+    if args.model:
+        from checkpoint import load_model
+        model = load_model(args.model)
+    else:
+        model = build_model(args)
+        model.masked = args.masked
+        model.vocab = {'<pad>': 0, '<unk>': 1, '<num>': 2}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'model.ts')
+        export.export_model(model, path, args.prompt_id, chunk_slots=args.chunk_slots)
+        module, metadata = inference.load_exported(path)
+    failed = False
+    for batch_size in args.batch_sizes:
+        input = export.example_input(batch_size, metadata['max_sentnum'], metadata['max_sentlen'],
+                                     model.word_att_net.lookup.num_embeddings)
+        with torch.no_grad():
+            diff = (model(input) - module(input)).abs().max().item()
+        failed |= diff > args.atol
+        eager = batch_size / time_forward(lambda m, x: m(x), model, input, args.repeats)
+        exported = batch_size / time_forward(lambda m, x: m(x), module, input, args.repeats)
+        logger.info('batch %3d: eager %8.2f ms, exported %8.2f ms, speedup %.2fx, max abs diff %.3g'
+                    % (batch_size, 1000 * eager, 1000 * exported, eager / exported, diff))
+    return 1 if failed else 0
+
+
+def bench_threads(args):
+    """
+    多个线程共享同一个模型并发推理：检查每个线程的输出与单线程计算的结果一致，并统计总吞吐量（作文/秒）。
+    各线程的批大小不同，用于确认前向计算不依赖任何与批次有关的模型状态。
+    """
+    torch.set_num_threads(args.intra_threads)
+    model = build_model(args)
+    model.masked = args.masked
+    inputs = [random_batch(args.batch_sizes[i % len(args.batch_sizes)], args.max_sentnum, args.max_sentlen,
+                           args.vocab_size, seed=i) for i in range(args.num_requests)]
+    with torch.no_grad():
+        expected = [model(input) for input in inputs]
+
+    def score(index):
+        with torch.no_grad():
+            return index, model(inputs[index])
+
+    failed = False
+    num_essays = sum(len(input) for input in inputs)
+    single_rate = None
+    for num_threads in args.num_threads:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            start = time.time()
+            results = list(executor.map(score, range(len(inputs))))
+            elapsed = time.time() - start
+        diff = max((expected[index] - output).abs().max().item() for index, output in results)
+        failed |= diff > args.atol
+        rate = num_essays / elapsed
+        single_rate = single_rate or rate
+        logger.info('%2d threads: %8.1f essays/s, speedup %.2fx, max abs diff %.3g'
+                    % (num_threads, rate, rate / single_rate, diff))
+    return 1 if failed else 0
+
+
+def bench_sparse(args):
+    """对比稠密与稀疏词嵌入梯度下每个训练步（前向、反向和优化器更新）的耗时"""
+    torch.set_num_threads(args.threads) if args.threads > 0 else None
+    input = random_batch(args.batch_size, args.max_sentnum, args.max_sentlen, args.active_words)
+    label = torch.rand(args.batch_size, 1)
+    criterion = torch.nn.MSELoss()
+    for vocab_size in args.vocab_sizes:
+        args.vocab_size = vocab_size
+        timings = {}
+        for sparse in (False, True):
+            model = build_model(args)
+            model.train()
+            model.word_att_net.lookup.weight.requires_grad = True
+            optimizer = utils.build_optimizer(model, 0.001, sparse)
+            forward_time, step_time = 0., 0.
+            for step in range(args.steps + 1):
+                start = time.time()
+                optimizer.zero_grad()
+                loss = criterion(model(input), label)
+                middle = time.time()
+                loss.backward()
+                optimizer.step()
+                # 第一步用于预热，不计时
+                if step:
+                    forward_time += middle - start
+                    step_time += time.time() - middle
+            timings[sparse] = (forward_time / args.steps, step_time / args.steps)
+        (dense_forward, dense_step), (sparse_forward, sparse_step) = timings[False], timings[True]
+        logger.info('vocab %7d: dense %8.1f ms/step (backward + update %8.1f ms), sparse %8.1f ms/step '
+                    '(backward + update %8.1f ms), speedup %.2fx'
+                    % (vocab_size, 1000 * (dense_forward + dense_step), 1000 * dense_step,
+                       1000 * (sparse_forward + sparse_step), 1000 * sparse_step,
+                       (dense_forward + dense_step) / (sparse_forward + sparse_step)))
+    logger.info('QWK: compare "python train.py ..." with and without --sparse_embedding on the same folds')
+    return 0
+
+
+def train_step_memory(args, batch_size, checkpoint_activations):
+    """
+    在当前进程中运行训练步，返回(本批训练步使RSS峰值增加的字节数, 前向计算为反向传播保存的激活字节数, 每秒处理的作文数)。
+    RSS还包含内存分配器缓存的空闲内存；进程的RSS峰值只增不减，因此每次测量都应在新的进程中进行，见bench_checkpoint。
+    """
+    import resource
+    model = build_model(args)
+    model.train()
+    model.masked = args.masked
+    model.checkpoint_activations = checkpoint_activations
+    model.word_att_net.lookup.weight.requires_grad = True
+    optimizer = utils.build_optimizer(model, 0.001)
+    criterion = torch.nn.MSELoss()
+
+    def step(input):
+        optimizer.zero_grad()
+        criterion(model(input), torch.zeros(input.size(0), 1)).backward()
+        optimizer.step()
+
+    # 用一篇作文预热，使参数梯度和优化器状态在测量前分配好
+    step(random_batch(1, args.max_sentnum, args.max_sentlen, args.vocab_size))
+    input = random_batch(batch_size, args.max_sentnum, args.max_sentlen, args.vocab_size)
+    with open('/proc/self/statm') as statm:
+        rss = int(statm.read().split()[1]) * resource.getpagesize()
+    step(input)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.time()
+    for _ in range(args.repeats):
+        step(input)
+    rate = args.repeats * batch_size / (time.time() - start)
+
+    # 统计前向计算为反向传播保存的张量（不含参数），按存储去重
+    parameters = set(p.untyped_storage().data_ptr() for p in model.parameters())
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(input)
+    return max(peak - rss, 0), sum(saved.values()), rate
+
+
+def bench_checkpoint(args):
+    """
+    对比启用与不启用激活检查点时训练步的内存峰值和吞吐量，并估算给定内存预算下能容纳的最大批大小。
+    每次测量在新的Python进程中进行（读取/proc和ru_maxrss，仅支持Linux）。
+    """
+    options = dict((key, value) for key, value in vars(args).items() if key != 'func')
+    results = {}
+    for checkpoint_activations in (False, True):
+        for batch_size in args.batch_sizes:
+            code = ('import sys, json, argparse; sys.path.insert(0, %r); import benchmark; '
+                    'print(json.dumps(benchmark.train_step_memory(argparse.Namespace(**%r), %d, %r)))'
+                    % (os.path.dirname(os.path.abspath(__file__)), options, batch_size, checkpoint_activations))
+            output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                    universal_newlines=True).stdout
+            results[checkpoint_activations, batch_size] = json.loads(output.strip().split('\n')[-1])
+    for batch_size in args.batch_sizes:
+        (peak, saved, rate), (ckpt_peak, ckpt_saved, ckpt_rate) = results[False, batch_size], results[True, batch_size]
+        logger.info('batch %4d: plain peak %7.1f MB (saved %7.1f MB) %6.1f essays/s, checkpointed peak %7.1f MB '
+                    '(saved %7.1f MB) %6.1f essays/s, peak %.2fx less, throughput %.2fx'
+                    % (batch_size, peak / 2. ** 20, saved / 2. ** 20, rate, ckpt_peak / 2. ** 20,
+                       ckpt_saved / 2. ** 20, ckpt_rate, peak / max(ckpt_peak, 1), ckpt_rate / rate))
+    # 以最大批大小的测量结果估算每篇作文的内存
+    largest = max(args.batch_sizes)
+    per_essay = [results[checkpoint_activations, largest][0] / float(largest) for checkpoint_activations in (False, True)]
+    budget = args.memory_budget * 2. ** 20
+    logger.info('%.0f MB budget: plain fits about %d essays per batch, checkpointed about %d (%.1fx)'
+                % (args.memory_budget, budget / per_essay[0], budget / max(per_essay[1], 1),
+                   per_essay[0] / max(per_essay[1], 1)))
+    return 0
+
+
+def time_loader(loader, epochs):
+    """返回(从开始迭代到取得第一批的秒数, 每轮的平均秒数, 第一轮的批次)"""
+    start = time.time()
+    iterator = iter(loader)
+    first = next(iterator)
+    startup = time.time() - start
+    batches = [first] + list(iterator)
+    elapsed = time.time() - start
+    for _ in range(epochs - 1):
+        for _ in loader:
+            pass
+    return startup, (time.time() - start) / epochs if epochs > 1 else elapsed, batches
+
+
+def bench_loader(args):
+    """
+    对比进程内批迭代器与原来的DataLoader(num_workers=3)遍历内存中张量的启动时间和每轮耗时，不包含模型计算。
+    不打乱时检查两者产出的批次完全相同。
+    """
+    from torch.utils.data import DataLoader, TensorDataset
+    from essay_dataset import BatchIterator, trim_collate
+    essays, scores = random_essays(args.num_essays, args.max_sentnum, args.max_sentlen)
+    X, Y, _ = utils.padding_sentence_sequences(essays, scores, args.max_sentnum, args.max_sentlen, dtype=np.int64)
+    dataset = TensorDataset(torch.from_numpy(X), torch.from_numpy(Y))
+    collate = trim_collate if args.trim else None
+    failed = False
+    for shuffle in (False, True):
+        loaders = [('DataLoader(num_workers=%d)' % args.num_workers,
+                    DataLoader(dataset, args.batch_size, shuffle=shuffle, num_workers=args.num_workers, collate_fn=collate))]
+        for prefetch in args.prefetch:
+            loaders.append(('BatchIterator(prefetch=%d)' % prefetch,
+                            BatchIterator(dataset, args.batch_size, shuffle=shuffle, trim=args.trim, prefetch=prefetch)))
+        reference = None
+        for name, loader in loaders:
+            startup, epoch_time, batches = time_loader(loader, args.epochs)
+            logger.info('shuffle=%-5s %-26s startup %8.1f ms, %8.1f ms/epoch (%d batches)'
+                        % (shuffle, name, 1000 * startup, 1000 * epoch_time, len(batches)))
+            if not shuffle:
+                if reference is None:
+                    reference = batches
+                else:
+                    failed |= not all(len(a) == len(b) and all(torch.equal(x, y) for x, y in zip(a, b))
+                                      for a, b in zip(reference, batches))
+    # 回归检查：每篇作文开头插入一个空句子，批大小为1时每批都有共同的空句子位置，裁剪后不能丢掉任何词
+    shifted = np.zeros_like(X)
+    shifted[:, 1:] = X[:, :-1]
+    loader = BatchIterator(TensorDataset(torch.from_numpy(shifted), torch.from_numpy(Y)), 1, shuffle=False, trim=True)
+    lost = int((shifted != 0).sum()) - sum(int((batch[0] != 0).sum()) for batch in loader)
+    failed |= lost != 0
+    logger.info('leading empty sentence: %d tokens lost by trimming' % lost)
+    # 回归检查：消费者提前停止后预取线程必须退出，不能阻塞在已满的队列上
+    threads = threading.active_count()
+    loader = BatchIterator(dataset, 1, shuffle=False, prefetch=1)
+    for _ in loader:
+        break
+    batches = iter(loader)
+    next(batches)
+    loader.close()
+    leaked = threading.active_count() - threads
+    failed |= leaked != 0
+    logger.info('prefetch threads left after early stop: %d' % leaked)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the essay scoring pipeline")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    tokenize_parser = subparsers.add_parser('tokenize', help='Compare single pass tokenization with the legacy pipeline')
+    tokenize_parser.add_argument('--datapath', type=str, default='data/fold_', help='Base path for data')
+    tokenize_parser.add_argument('--num_folds', type=int, default=5, help='Number of folds to compare')
+    tokenize_parser.add_argument('--prompt_id', type=int, default=0, help='Prompt ID of the essay set, <= 0 for all')
+    tokenize_parser.add_argument('--show', type=int, default=5, help='Number of mismatches to print')
+    tokenize_parser.set_defaults(func=bench_tokenize)
+
+    tokenizer_parser = subparsers.add_parser('tokenizer', help='Mismatch report of the regex tokenizer against nltk')
+    tokenizer_parser.add_argument('--datapath', type=str, default='data/fold_', help='Base path for data')
+    tokenizer_parser.add_argument('--num_folds', type=int, default=5, help='Number of folds to compare')
+    tokenizer_parser.add_argument('--prompt_id', type=int, default=0, help='Prompt ID of the essay set, <= 0 for all')
+    tokenizer_parser.add_argument('--show', type=int, default=20, help='Number of most frequent mismatches to print')
+    tokenizer_parser.set_defaults(func=bench_tokenizer)
+
+    padding_parser = subparsers.add_parser('padding', help='Time vectorized padding against the legacy loops')
+    padding_parser.add_argument('--num_essays', type=int, default=10000, help='Number of random essays')
+    padding_parser.add_argument('--max_sentnum', type=int, default=71, help='Max number of sentences per essay')
+    padding_parser.add_argument('--max_sentlen', type=int, default=50, help='Max number of words per sentence')
+    padding_parser.set_defaults(func=bench_padding)
+
+    model_parser = subparsers.add_parser('model', help='Essays/sec of the batched HierAttNet forward against the per-sentence loop')
+    model_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[10, 32, 64, 128, 256], help='Batch sizes to time')
+    model_parser.add_argument('--word_chunk_sizes', type=int, nargs='+', default=[64, 128, 256, 0],
+                              help='Sentences per word-level call to time, 0 for all at once')
+    model_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    model_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    model_parser.add_argument('--vocab_size', type=int, default=4000, help='Vocabulary size of the random embedding')
+    model_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    model_parser.add_argument('--repeats', type=int, default=3, help='Timed forward passes per batch size')
+    model_parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 for the default')
+    model_parser.add_argument('--atol', type=float, default=1e-6, help='Allowed absolute difference of the outputs')
+    model_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    model_parser.set_defaults(func=bench_model)
+
+    masked_parser = subparsers.add_parser('masked', help='Essays/sec of the masked forward with packed sentence LSTM')
+    masked_parser.add_argument('--datapath', type=str, default=None, help='Base path for data, random essays if not set')
+    masked_parser.add_argument('--prompt_id', type=int, default=1, help='Prompt ID of the essay set')
+    masked_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[10, 64, 256], help='Batch sizes to time')
+    masked_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    masked_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    masked_parser.add_argument('--vocab_size', type=int, default=4000, help='Vocabulary size')
+    masked_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    masked_parser.add_argument('--repeats', type=int, default=3, help='Timed forward passes per batch size')
+    masked_parser.add_argument('--atol', type=float, default=1e-5, help='Allowed absolute difference of the outputs')
+    masked_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    masked_parser.set_defaults(func=bench_masked)
+
+    dtype_parser = subparsers.add_parser('dtype', help='Essays/sec of float32 against bfloat16 autocast')
+    dtype_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[10, 64, 256], help='Batch sizes to time')
+    dtype_parser.add_argument('--masked', action='store_true', help='Time the masked forward')
+    dtype_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    dtype_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    dtype_parser.add_argument('--vocab_size', type=int, default=4000, help='Vocabulary size of the random embedding')
+    dtype_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    dtype_parser.add_argument('--repeats', type=int, default=3, help='Timed forward passes per batch size')
+    dtype_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    dtype_parser.set_defaults(func=bench_dtype)
+
+    export_parser = subparsers.add_parser('export', help='Latency of the eager model against the TorchScript export')
+    export_parser.add_argument('--model', type=str, default=None, help='Model saved by train.py, a random model if not set')
+    export_parser.add_argument('--prompt_id', type=int, default=1, help='Prompt ID stored in the export metadata')
+    export_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 64], help='Batch sizes to time')
+    export_parser.add_argument('--masked', action='store_true', help='Export the random model in masked mode')
+    export_parser.add_argument('--chunk_slots', type=int, default=2, help='Sentence positions per word-level call')
+    export_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    export_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    export_parser.add_argument('--vocab_size', type=int, default=4000, help='Vocabulary size of the random embedding')
+    export_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    export_parser.add_argument('--repeats', type=int, default=5, help='Timed forward passes per batch size')
+    export_parser.add_argument('--atol', type=float, default=1e-5, help='Allowed absolute difference of the outputs')
+    export_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    export_parser.set_defaults(func=bench_export)
+
+    threads_parser = subparsers.add_parser('threads', help='Essays/sec of concurrent inference on one shared model')
+    threads_parser.add_argument('--num_threads', type=int, nargs='+', default=[1, 2, 4], help='Numbers of threads to time')
+    threads_parser.add_argument('--intra_threads', type=int, default=1, help='torch CPU threads used by each forward')
+    threads_parser.add_argument('--num_requests', type=int, default=32, help='Number of batches to score')
+    threads_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 10], help='Batch sizes of the requests')
+    threads_parser.add_argument('--masked', action='store_true', help='Use the masked forward')
+    threads_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    threads_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    threads_parser.add_argument('--vocab_size', type=int, default=4000, help='Vocabulary size of the random embedding')
+    threads_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    threads_parser.add_argument('--atol', type=float, default=1e-6, help='Allowed absolute difference of the outputs')
+    threads_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    threads_parser.set_defaults(func=bench_threads)
+
+    sparse_parser = subparsers.add_parser('sparse', help='Time per training step with dense and sparse embedding gradients')
+    sparse_parser.add_argument('--vocab_sizes', type=int, nargs='+', default=[4000, 50000, 400000], help='Vocabulary sizes to time')
+    sparse_parser.add_argument('--active_words', type=int, default=1000, help='Word ids drawn for the batch')
+    sparse_parser.add_argument('--batch_size', type=int, default=10, help='Number of essays per step')
+    sparse_parser.add_argument('--steps', type=int, default=5, help='Timed training steps')
+    sparse_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    sparse_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    sparse_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    sparse_parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 for the default')
+    sparse_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    sparse_parser.set_defaults(func=bench_sparse)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='Peak training memory and essays/sec with activation checkpointing')
+    checkpoint_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[10, 32, 64], help='Batch sizes to measure')
+    checkpoint_parser.add_argument('--memory_budget', type=float, default=2048, help='RAM budget in MB for the batch size estimate')
+    checkpoint_parser.add_argument('--masked', action='store_true', help='Use the masked forward')
+    checkpoint_parser.add_argument('--max_sentnum', type=int, default=100, help='Number of sentences per essay')
+    checkpoint_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    checkpoint_parser.add_argument('--vocab_size', type=int, default=4000, help='Vocabulary size of the random embedding')
+    checkpoint_parser.add_argument('--connector_dict', type=str, default='connector_dict.json', help='Connector dictionary path')
+    checkpoint_parser.add_argument('--repeats', type=int, default=2, help='Timed training steps per measurement')
+    checkpoint_parser.add_argument('--seed', type=int, default=123, help='Random seed')
+    checkpoint_parser.set_defaults(func=bench_checkpoint)
+
+    loader_parser = subparsers.add_parser('loader', help='Startup and per-epoch time of BatchIterator against DataLoader workers')
+    loader_parser.add_argument('--num_essays', type=int, default=1400, help='Number of random essays')
+    loader_parser.add_argument('--batch_size', type=int, default=10, help='Number of essays per batch')
+    loader_parser.add_argument('--epochs', type=int, default=3, help='Timed epochs per loader')
+    loader_parser.add_argument('--num_workers', type=int, default=3, help='DataLoader workers, as in train.py before')
+    loader_parser.add_argument('--prefetch', type=int, nargs='+', default=[0, 2], help='Prefetch depths of BatchIterator to time')
+    loader_parser.add_argument('--trim', action='store_true', help='Trim each batch, as with --bucket')
+    loader_parser.add_argument('--max_sentnum', type=int, default=71, help='Number of sentences per essay')
+    loader_parser.add_argument('--max_sentlen', type=int, default=50, help='Number of words per sentence')
+    loader_parser.set_defaults(func=bench_loader)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+训练检查点：模型和优化器的state_dict、轮数、折号和随机数状态，由后台线程写入磁盘，可用train.py --resume继续训练。
+
+最佳模型同样只保存state_dict和构建模型所需的配置，用load_model重新构建，不依赖pickle整个模块。
+"""
+import atexit
+import os
+import random
+import threading
+from queue import Queue
+import numpy as np
+import torch
+from vocab import Vocab
+
+
+def snapshot(obj):
+    """复制嵌套的字典、列表中的所有张量到CPU，之后训练继续原地更新参数也不会影响快照"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return dict((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    """返回torch、CUDA、numpy和random的随机数状态"""
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+    }
+
+
+def set_rng_state(state):
+    """恢复get_rng_state保存的随机数状态"""
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+
+class CheckpointWriter(object):
+    def __init__(self):
+        """
+        后台线程写检查点：save在调用线程中只复制张量，序列化和写文件在后台线程中进行。
+        每个文件先写入临时文件再替换，中断时不会留下不完整的检查点；进程因异常退出时会先写完已提交的检查点。
+        """
+        self.queue = Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, path = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, path):
+        """复制state中的张量后交给后台线程写入path"""
+        self._check()
+        self.queue.put((snapshot(state), path))
+
+    def wait(self):
+        """等待已提交的检查点全部写完"""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        atexit.unregister(self.wait)
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def model_state(model, tokenization=None):
+    """最佳模型文件的内容：state_dict、构建模型所需的配置、词表和训练时的标记化设置（reader.tokenization_settings）"""
+    lookup = model.word_att_net.lookup.weight
+    vocab = model.vocab
+    return {
+        'config': {
+            'word_hidden_size': model.word_hidden_size,
+            'sent_hidden_size': model.sent_hidden_size,
+            'vocab_size': lookup.size(0),
+            'embedd_dim': lookup.size(1),
+            'max_sentnum': model.max_sent_length,
+            'max_sentlen': model.max_word_length,
+            'masked': model.masked,
+            'connector_weighting': model.connector_weighting,
+        },
+        'vocab': None if vocab is None else list(vocab.words) if hasattr(vocab, 'words') else sorted(vocab, key=vocab.get),
+        'model': model.state_dict(),
+        'tokenization': tokenization,
+    }
+
+
+def load_model(model_path, device='cpu', connector_dict_path='connector_dict.json'):
+    """
+    加载train.py保存的最佳模型（net_fold{折号}.pt）。也接受旧版本pickle整个模型的文件（net.pkl）。
+
+    :return: eval模式的HierAttNet，训练时的标记化设置保存在其tokenization属性中（旧版本的文件为None）
+    """
+    from hierarchical_att_model import HierAttNet
+    state = torch.load(model_path, map_location=device, weights_only=False)
+    if isinstance(state, torch.nn.Module):
+        state.tokenization = getattr(state, 'tokenization', None)
+        return state.eval()
+    config = state['config']
+    vocab = Vocab(state['vocab'], state.get('tokenization')) if state['vocab'] is not None else None
+    model = HierAttNet(config['word_hidden_size'], config['sent_hidden_size'], 10,
+                       np.zeros([config['vocab_size'], config['embedd_dim']], dtype=np.float32),
+                       config['max_sentnum'], config['max_sentlen'], connector_dict_path, vocab=vocab,
+                       masked=config['masked'], connector_weighting=config.get('connector_weighting', True))
+    model.load_state_dict(state['model'])
+    model.tokenization = state.get('tokenization')
+    return model.to(device).eval()
@@ -0,0 +1,25 @@
+"""
+将文本格式的词向量文件一次性转换为二进制嵌入存储（float32矩阵 + 词索引），训练时可内存映射加载。
+
+用法示例：
+python convert_embedding.py --embedding glove --embedding_dict glove.6B.50d.txt --output glove.6B.50d.npy
+python train.py --oov embedding --embedding glove --embedding_dict glove.6B.50d.npy --embedding_dim 50 --datapath data/fold_ --prompt_id 1
+"""
+import argparse
+import utils
+
+# 初始化日志记录器
+logger = utils.get_logger("Convert embedding ...")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a text embedding file to a binary embedding store")
+    parser.add_argument('--embedding', type=str, default='glove', help='Word embedding type, senna or glove')
+    parser.add_argument('--embedding_dict', type=str, required=True, help='Pretrained embedding path')
+    parser.add_argument('--output', type=str, required=True, help='Output path of the store, ending with .npy')
+    args = parser.parse_args()
+    utils.convert_embedding_store(args.embedding, args.embedding_dict, args.output, logger)
+
+
+if __name__ == '__main__':
+    main()
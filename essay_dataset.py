@@ -0,0 +1,323 @@
+import threading
+from queue import Empty, Full, Queue
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+import reader
+from vocab import Vocab
+
+
+class EssayStreamDataset(IterableDataset):
+    def __init__(self, file_path, prompt_id, vocab, batch_size=10, max_sentnum=reader.MAX_SENTNUM,
+                 max_sentlen=reader.MAX_SENTLEN, to_lower=True, score_index=6, scale_scores=False, return_ids=False):
+        """
+        流式读取作文数据集：逐行读取TSV，即时标记化、编码，并按固定批大小产出填充后的张量。
+
+        内存占用只与批大小和max_sentnum * max_sentlen有关，与数据集大小无关。
+        超过max_sentnum的句子和超过max_sentlen的词会被截断。
+
+        :param file_path: TSV数据文件路径
+        :param prompt_id: 提示ID，<=0时读取全部作文
+        :param vocab: 词汇表
+        :param batch_size: 每批作文数
+        :param max_sentnum: 每篇作文的句子数（填充后的维度）
+        :param max_sentlen: 每个句子的词数（填充后的维度）
+        :param to_lower: 是否将文本转换为小写
+        :param score_index: 分数所在的列
+        :param scale_scores: 是否将分数转换为0-1范围的模型友好分数
+        :param return_ids: 是否在每批中额外返回作文ID
+        """
+        super(EssayStreamDataset, self).__init__()
+        self.file_path = file_path
+        self.prompt_id = prompt_id
+        self.vocab = Vocab.from_dict(vocab)
+        self.batch_size = batch_size
+        self.max_sentnum = max_sentnum
+        self.max_sentlen = max_sentlen
+        self.to_lower = to_lower
+        self.score_index = score_index
+        self.scale_scores = scale_scores
+        self.return_ids = return_ids
+
+    def _rows(self):
+        """逐行产出作文；在DataLoader多进程中，每个worker只处理属于自己的行"""
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info else 1
+        worker_id = worker_info.id if worker_info else 0
+        rows = reader.iter_tsv_rows(self.file_path, self.prompt_id, self.score_index)
+        for index, row in enumerate(rows):
+            if index % num_workers == worker_id:
+                yield row
+
+    def _pad_batch(self, essay_ids, prompt_ids, essays, scores):
+        """将一批作文的词索引填充为(batch, max_sentnum, max_sentlen)的张量"""
+        X = np.zeros([len(essays), self.max_sentnum, self.max_sentlen], dtype=np.int64)
+        for i, sent_indices in enumerate(essays):
+            for j, indices in enumerate(sent_indices[:self.max_sentnum]):
+                indices = indices[:self.max_sentlen]
+                X[i, j, :len(indices)] = indices
+        Y = np.array(scores, dtype=np.float32).reshape(-1, 1)
+        if self.scale_scores:
+            Y = reader.get_model_friendly_scores(Y, prompt_ids)
+        batch = (torch.from_numpy(X), torch.from_numpy(Y))
+        if self.return_ids:
+            batch += (torch.tensor(essay_ids),)
+        return batch
+
+    def __iter__(self):
+        essay_ids, prompt_ids, essays, scores = [], [], [], []
+        for essay_id, essay_set, content, score in self._rows():
+            sent_tokens = reader.text_tokenizer(content, replace_url_flag=True, tokenize_sent_flag=True)
+            if self.to_lower:
+                sent_tokens = [[w.lower() for w in s] for s in sent_tokens]
+            sent_indices, _, _ = self.vocab.encode(sent_tokens)
+            essay_ids.append(essay_id)
+            prompt_ids.append(essay_set)
+            essays.append(sent_indices)
+            scores.append(score)
+            if len(essays) == self.batch_size:
+                yield self._pad_batch(essay_ids, prompt_ids, essays, scores)
+                essay_ids, prompt_ids, essays, scores = [], [], [], []
+        if essays:
+            yield self._pad_batch(essay_ids, prompt_ids, essays, scores)
+
+
+class RaggedEssayDataset(Dataset):
+    def __init__(self, essays, scores, min_sentlen=5, prompt_ids=None):
+        """
+        基于RaggedEssays的数据集，配合collate在组批时才构建稠密张量，每批只填充到本批的最大句子数和句子长度。
+
+        使用方式：DataLoader(dataset, batch_size, shuffle=True, collate_fn=dataset.collate)
+
+        :param essays: utils.RaggedEssays
+        :param scores: 分数数组，形状为(N, 1)
+        :param min_sentlen: 填充后句子长度的下限，不能小于WordAttNet卷积核的大小
+        :param prompt_ids: 可选，每篇作文的提示ID；给出时每批额外返回提示ID
+        """
+        super(RaggedEssayDataset, self).__init__()
+        assert len(essays) == len(scores)
+        self.essays = essays
+        self.scores = torch.as_tensor(np.asarray(scores, dtype=np.float32).reshape(-1, 1))
+        self.min_sentlen = min_sentlen
+        self.prompt_ids = None if prompt_ids is None else torch.as_tensor(np.asarray(prompt_ids, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.essays)
+
+    def __getitem__(self, index):
+        # 只返回下标，真正的数据在collate中成批取出
+        return index
+
+    def collate(self, indices):
+        """将一批作文下标转换为(X, Y)或(X, Y, 提示ID)，X形状为(batch, 本批最大句子数, 本批最大句子长度)"""
+        X = self.essays.to_dense(indices, min_sentlen=self.min_sentlen)
+        if self.prompt_ids is None:
+            return torch.from_numpy(X), self.scores[indices]
+        return torch.from_numpy(X), self.scores[indices], self.prompt_ids[indices]
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=50):
+        """
+        按长度分桶的批采样器：打乱后每bucket_size个批次的作文为一组，组内按长度排序后切分成批，再打乱批次顺序。
+        同一批作文的句子数相近，配合trim_collate或RaggedEssayDataset.collate可以大幅减少填充。
+
+        :param lengths: 每篇作文的长度（句子数）
+        :param batch_size: 每批作文数
+        :param shuffle: 是否随机化；为False时按长度排序全部作文，适合开发集和测试集
+        :param bucket_size: 每组包含的批次数
+        """
+        super(BucketBatchSampler, self).__init__()
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def batches(self):
+        """返回一轮的批次（下标数组列表）"""
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind='stable')
+            return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        indices = np.random.permutation(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def last_used(used):
+    """布尔数组或张量中最后一个True的位置加1，全为False时为0"""
+    positions = np.arange(1, len(used) + 1)
+    return int((np.asarray(used) * positions).max()) if len(used) else 0
+
+
+def trim_padding(X, min_sentlen=5):
+    """
+    将(batch, 句子数, 句子长度)的填充张量裁剪到本批的最大句子数和句子长度，句子长度不小于min_sentlen。
+    只应用于忽略填充（masked）的模型，否则模型的输出会随本批的填充量变化。
+    作文中间可能有空句子（见reader.shorten_tokens），因此裁剪到最后一个非空的句子位置，而不是按非空位置计数。
+    """
+    used = X != 0
+    sentnum = max(last_used(used.any(2).any(0)), 1)
+    sentlen = min(max(last_used(used.any(1).any(0)), min_sentlen), X.size(2))
+    return X[:, :sentnum, :sentlen]
+
+
+def trim_collate(batch, min_sentlen=5):
+    """TensorDataset的组批函数：堆叠后裁剪到本批的最大句子数和句子长度"""
+    X = torch.stack([item[0] for item in batch])
+    Y = torch.stack([item[1] for item in batch])
+    return trim_padding(X, min_sentlen), Y
+
+
+def dense_essay_shapes(X):
+    """返回填充后数组中每篇作文的(句子数, 最长句子的词数, 总词数)，句子数为最后一个非空句子的位置加1"""
+    sent_lens = (np.asarray(X) != 0).sum(2)
+    sentnums = ((sent_lens > 0) * np.arange(1, sent_lens.shape[1] + 1)).max(1)
+    return sentnums, sent_lens.max(1), sent_lens.sum(1)
+
+
+def padding_fraction(essay_shapes, batches, min_sentlen=5):
+    """
+    计算按批裁剪后填充位置所占的比例。
+
+    :param essay_shapes: dense_essay_shapes或RaggedEssays.essay_shapes的结果
+    :param batches: 下标数组列表
+    """
+    sentnums, max_sentlens, num_tokens = essay_shapes
+    real, total = 0, 0
+    for batch in batches:
+        batch = np.asarray(batch)
+        real += int(num_tokens[batch].sum())
+        total += len(batch) * max(int(sentnums[batch].max()), 1) * max(int(max_sentlens[batch].max()), min_sentlen)
+    return 1. - float(real) / max(total, 1)
+
+
+class BatchIterator(object):
+    def __init__(self, dataset, batch_size, shuffle=True, batch_sampler=None, trim=False, prefetch=0, pin_memory=False):
+        """
+        进程内的批迭代器，用于替代对内存中张量使用多进程DataLoader：每轮打乱一次下标，按下标切片整批取出，
+        不需要逐个样本取出再拼接，也不需要启动worker进程。不打乱时每批是原张量的连续切片，不复制数据。
+
+        :param dataset: TensorDataset或RaggedEssayDataset
+        :param batch_size: 每批作文数
+        :param shuffle: 是否每轮打乱顺序，使用torch的全局随机数生成器
+        :param batch_sampler: 可选，提供batches()的批采样器（如BucketBatchSampler），给出时忽略batch_size和shuffle
+        :param trim: 是否将每批裁剪到本批的最大句子数和句子长度（TensorDataset）
+        :param prefetch: 后台线程提前准备的批数，0表示迭代时才准备
+        :param pin_memory: 是否将每批放入锁页内存，以便异步复制到GPU；没有GPU时忽略
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batch_sampler = batch_sampler
+        self.trim = trim
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        # 正在运行的预取线程及其停止标志
+        self._workers = []
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def batch_indices(self):
+        """返回一轮的批次，每个批次是下标张量或切片"""
+        if self.batch_sampler is not None:
+            return [torch.as_tensor(batch) for batch in self.batch_sampler.batches()]
+        if self.shuffle:
+            return torch.randperm(len(self.dataset)).split(self.batch_size)
+        return [slice(start, start + self.batch_size) for start in range(0, len(self.dataset), self.batch_size)]
+
+    def fetch(self, indices):
+        """按下标取出一批"""
+        if isinstance(self.dataset, RaggedEssayDataset):
+            if isinstance(indices, slice):
+                indices = np.arange(len(self.dataset))[indices]
+            batch = self.dataset.collate(np.asarray(indices))
+        else:
+            batch = tuple(tensor[indices] for tensor in self.dataset.tensors)
+            if self.trim:
+                batch = (trim_padding(batch[0]),) + batch[1:]
+        if self.pin_memory:
+            batch = tuple(tensor.pin_memory() for tensor in batch)
+        return batch
+
+    def __iter__(self):
+        batches = self.batch_indices()
+        if self.prefetch > 0:
+            return self._prefetch(batches)
+        return (self.fetch(indices) for indices in batches)
+
+    def _prefetch(self, batches):
+        """
+        在后台线程中提前准备批次；取批时的异常在迭代处重新抛出。
+        迭代结束、提前中断（break或生成器被回收）或调用close()时设置停止标志并等待线程退出。
+        """
+        queue = Queue(self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # 带超时地放入队列，以便消费者停止后生产者不会永远阻塞
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for indices in batches:
+                    if not put(self.fetch(indices)):
+                        return
+                put(None)
+            except Exception as error:
+                put(error)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        worker = (stop, thread)
+        self._workers.append(worker)
+        thread.start()
+        try:
+            while True:
+                try:
+                    batch = queue.get(timeout=0.1)
+                except Empty:
+                    # close()之后生产者不再放入批次
+                    if stop.is_set():
+                        return
+                    continue
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            if worker in self._workers:
+                self._workers.remove(worker)
+
+    def close(self):
+        """停止所有预取线程并等待其退出"""
+        for stop, thread in self._workers:
+            stop.set()
+        for stop, thread in self._workers:
+            thread.join()
+        self._workers = []
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,97 @@
+"""
+将train.py保存的模型导出为TorchScript文件，词表和最大形状等元数据一并写入，评分时用inference.py加载，不需要训练代码。
+
+用法示例：
+python export.py --model net_fold0.pt --prompt_id 1 --output net.ts
+python export.py --model net_fold0.pt --prompt_id 1 --vocab vocab_fold0.bin --output net.ts
+python export.py --model net_fold0.pt --prompt_id 0 --output net.ts  # 所有题目联合训练的模型，评分时需给出每篇作文的题目
+"""
+import argparse
+import copy
+import json
+import torch
+import utils
+import reader
+from checkpoint import load_model
+
+# 初始化日志记录器
+logger = utils.get_logger("Export model ...")
+
+# 导出文件中元数据的文件名
+METADATA_FILE = 'metadata.json'
+
+
+def example_input(batch_size, max_sentnum, max_sentlen, vocab_size, seed=123):
+    """生成用于追踪的随机词索引，每篇作文的句子数和句子长度随机"""
+    generator = torch.Generator().manual_seed(seed)
+    input = torch.randint(3, vocab_size, (batch_size, max_sentnum, max_sentlen), generator=generator)
+    sentnums = torch.randint(1, max_sentnum + 1, (batch_size, 1, 1), generator=generator)
+    sentlens = torch.randint(1, max_sentlen + 1, (batch_size, max_sentnum, 1), generator=generator)
+    valid = (torch.arange(max_sentnum).view(1, -1, 1) < sentnums) & (torch.arange(max_sentlen).view(1, 1, -1) < sentlens)
+    return input * valid
+
+
+def export_model(model, output_path, prompt_id, vocab=None, chunk_slots=2, tokenization=None):
+    """
+    以torch.jit.trace导出模型。导出前关闭混合精度，单词级别注意力改为按句子位置分块，并让masked模式使用
+    与数据无关的张量形状，因此导出的模型可以接受任意批大小和句子长度（不小于卷积核大小）。
+    输入的句子数需等于max_sentnum，inference.ExportedScorer会负责填充。
+
+    :param prompt_id: 模型训练时的提示ID，<=0表示所有提示联合训练，元数据中写入每个提示的分数范围
+    :param chunk_slots: 单词级别注意力每块包含的句子位置数，0表示一次计算
+    :param tokenization: 训练时的标记化设置，写入元数据，默认取模型记录的设置
+    :return: 导出的TorchScript模块
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    model.autocast_dtype = None
+    model.static_shapes = True
+    model.word_chunk_slots = chunk_slots or None
+    vocab = vocab if vocab is not None else model.vocab
+    assert vocab is not None, "the model has no vocabulary, pass --vocab"
+    vocab_size = model.word_att_net.lookup.num_embeddings
+    max_sentnum, max_sentlen = model.max_sent_length, model.max_word_length
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input(8, max_sentnum, max_sentlen, vocab_size), check_trace=False)
+        # 在与追踪时不同的形状上检查导出结果
+        check = example_input(3, max_sentnum, max(max_sentlen // 2, 5), vocab_size, seed=7)
+        diff = (traced(check) - model(check)).abs().max().item()
+    logger.info('Max abs diff between eager and exported outputs on a %s batch: %.3g' % (tuple(check.shape), diff))
+
+    prompts = range(1, 9) if prompt_id <= 0 else [prompt_id]
+    metadata = {
+        'prompt_id': prompt_id,
+        'score_ranges': dict((str(prompt), list(utils.asap_ranges[prompt])) for prompt in prompts),
+        'max_sentnum': max_sentnum,
+        'max_sentlen': max_sentlen,
+        'min_sentlen': model.word_att_net.conv1.kernel_size[0],
+        'masked': model.masked,
+        'tokenization': tokenization if tokenization is not None else getattr(model, 'tokenization', None),
+        'vocab': list(vocab.words) if hasattr(vocab, 'words') else sorted(vocab, key=vocab.get),
+    }
+    torch.jit.save(traced, output_path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    logger.info('Exported model to %s (max_sentnum %d, max_sentlen %d, %d words)'
+                % (output_path, max_sentnum, max_sentlen, len(metadata['vocab'])))
+    return traced
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a trained HierAttNet to TorchScript")
+    parser.add_argument('--model', type=str, default='net_fold0.pt', help='Model saved by train.py')
+    parser.add_argument('--prompt_id', type=int, required=True, help='Prompt ID the model was trained on, <= 0 for a joint model')
+    parser.add_argument('--vocab', type=str, default=None, help='Vocabulary file, defaults to the one stored in the model')
+    parser.add_argument('--output', type=str, required=True, help='Output path of the TorchScript file')
+    parser.add_argument('--chunk_slots', type=int, default=2, help='Sentence positions per word-level call, 0 for all at once')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    if model.tokenization is not None:
+        # 加载词表时按模型训练时的标记化设置检查
+        reader.set_tokenization(model.tokenization['tokenizer'], model.tokenization['single_pass'])
+    vocab = reader.load_vocab(args.vocab) if args.vocab else None
+    export_model(model, args.output, args.prompt_id, vocab, args.chunk_slots,
+                 tokenization=model.tokenization or getattr(vocab, 'tokenization', None))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+基于预编译正则表达式的快速分词器，不依赖nltk。
+
+近似nltk.word_tokenize的切分结果：先按句号切分句子，再对每个句子按相同顺序应用与NLTKWordTokenizer相同的Treebank规则。
+分句使用基于常见缩写的启发式规则代替Punkt（只影响句末句号是否被拆开），在缩写、首字母等处可能与Punkt不同，
+差异可用benchmark.py tokenizer统计。
+"""
+import re
+
+# 常见缩写，其后的句号不视为句子结尾
+ABBREVIATIONS = {
+    'mr', 'mrs', 'ms', 'dr', 'st', 'jr', 'sr', 'prof', 'rev', 'gen', 'gov', 'sen', 'rep', 'capt', 'col', 'lt', 'sgt',
+    'vs', 'etc', 'inc', 'ltd', 'co', 'corp', 'dept', 'univ', 'no', 'vol', 'fig', 'approx', 'ave', 'blvd', 'mt', 'ft',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+}
+
+# 句末句号的候选位置：句号（及其后的右括号、引号）之后是空白
+_PERIOD_END = re.compile(r'(\S*?)(\.+)([\]\)}>"\'»”’]*)\s+')
+
+# Treebank起始引号规则
+_STARTING_QUOTES = [
+    (re.compile(u'([«“‘„]|[`]+)'), r' \1 '),
+    (re.compile(r'^\"'), r'``'),
+    (re.compile(r'(``)'), r' \1 '),
+    (re.compile(r'([ \(\[{<])(\"|\'{2})'), r'\1 `` '),
+    (re.compile(r"(?i)(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)"), r'\1 '),
+]
+
+# Treebank标点规则，顺序与NLTKWordTokenizer相同（依次为PUNCTUATION、PARENS_BRACKETS和DOUBLE_DASHES）。
+# 只合并相邻的、只在两侧补空格且作用于不同字符的规则，合并前后结果相同；
+# 括号必须在"([^'])' "规则之后补空格，否则会改变其后's等缩写的切分
+_PUNCTUATION = [
+    (re.compile(u'([^\\.])(\\.)([\\]\\)}>"\'»”’ ]*)\\s*$'), r'\1 \2 \3 '),
+    (re.compile(r'([:,])([^\d])'), r' \1 \2'),
+    (re.compile(r'([:,])$'), r' \1 '),
+    (re.compile(u'\\.{2,}|[;@#$%&‒-―]'), r' \g<0> '),
+    (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r'\1 \2\3 '),
+    (re.compile(r'[?!]'), r' \g<0> '),
+    (re.compile(r"([^'])' "), r"\1 ' "),
+    (re.compile(r'[*\]\[\(\)\{\}<>]|--'), r' \g<0> '),
+]
+
+# Treebank结束引号与缩写规则，作用于首尾补空格后的文本
+_ENDING_QUOTES = [
+    (re.compile(u'([»”’])'), r' \1 '),
+    (re.compile(r"''"), " '' "),
+    (re.compile(r'"'), " '' "),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r'\1 \2 '),
+    (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r'\1 \2 '),
+]
+
+# 预筛选：文本中没有对应字符时跳过整组规则
+_QUOTE_HINT = re.compile(u'[«“‘„`"\'»”’]')
+_CONTRACTION_HINT = re.compile(r"(?i)cannot|d'ye|gimme|gonna|gotta|lemme|more'n|wanna|'tis|'twas")
+
+_CONTRACTIONS = [re.compile(pattern) for pattern in [
+    r'(?i)\b(can)(?#X)(not)\b',
+    r"(?i)\b(d)(?#X)('ye)\b",
+    r'(?i)\b(gim)(?#X)(me)\b',
+    r'(?i)\b(gon)(?#X)(na)\b',
+    r'(?i)\b(got)(?#X)(ta)\b',
+    r'(?i)\b(lem)(?#X)(me)\b',
+    r"(?i)\b(more)(?#X)('n)\b",
+    r'(?i)\b(wan)(?#X)(na)(?=\s)',
+    r"(?i) ('t)(?#X)(is)\b",
+    r"(?i) ('t)(?#X)(was)\b",
+]]
+
+
+def _is_sentence_end(word, periods):
+    """判断句号前的词是否为句子结尾（缩写、首字母和省略号不算）"""
+    if len(periods) > 1:
+        return False
+    word = word.lstrip('([{<"\'`').lower()
+    if not word:
+        return True
+    if word in ABBREVIATIONS or '.' in word:
+        return False
+    if len(word) == 1 and word.isalpha():
+        return False
+    return True
+
+
+def sent_tokenize(text):
+    """将文本切分为句子，只在句号后切分（问号、感叹号不影响分词结果）"""
+    sents = []
+    start = 0
+    for match in _PERIOD_END.finditer(text):
+        if _is_sentence_end(match.group(1), match.group(2)):
+            sents.append(text[start:match.end(3)])
+            start = match.end()
+    sents.append(text[start:])
+    return sents
+
+
+def treebank_tokenize(text):
+    """对单个句子应用Treebank分词规则"""
+    has_quote = _QUOTE_HINT.search(text) is not None
+    has_contraction = _CONTRACTION_HINT.search(text) is not None
+    if has_quote:
+        for regexp, substitution in _STARTING_QUOTES:
+            text = regexp.sub(substitution, text)
+    for regexp, substitution in _PUNCTUATION:
+        text = regexp.sub(substitution, text)
+    # 结束引号和缩写规则依赖单个空格分隔，没有引号和缩写时最终的split已足够
+    if has_quote or has_contraction:
+        text = ' ' + text + ' '
+        for regexp, substitution in _ENDING_QUOTES:
+            text = regexp.sub(substitution, text)
+    if has_contraction:
+        for regexp in _CONTRACTIONS:
+            text = regexp.sub(r' \1 \2 ', text)
+    return text.split()
+
+
+def word_tokenize(text):
+    """与nltk.word_tokenize对应的分词函数"""
+    return [token for sent in sent_tokenize(text) for token in treebank_tokenize(sent)]
+
+
+def tokenize_batch(texts):
+    """批量分词，返回与输入顺序一致的标记列表"""
+    return [word_tokenize(text) for text in texts]
@@ -1,23 +1,98 @@
 import pandas as pd
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from sent_att_model import SentAttNet
 from word_att_model import WordAttNet
 import json
 
+# 衔接词字典的类别与衔接词权重文件中类别的对应关系
+CONNECTOR_CATEGORIES = {
+    '比较类': 'Contrast',
+    '因果类': 'Contingency',
+    '扩展类': 'Expansion',
+    '时间类': 'Temporal',
+}
+
+
+def compile_connector_table(connector_dict, connector_weights, vocab):
+    """
+    将衔接词（包括多词衔接词）编译为张量查找表。
+
+    每个出现在衔接词中的词得到一个1..K的紧凑编号，其余词为0；长度为n的衔接词编码为
+    sum(编号[k] * (K + 1) ** k)。同一衔接词出现在多个类别时以先出现的为准，含词表外词的衔接词被忽略。
+
+    :param connector_dict: {类别: {子类别: [衔接词]}}
+    :param connector_weights: {权重类别: 权重}
+    :param vocab: 词汇表
+    :return: (词表大小的紧凑编号张量, 升序的衔接词编码, 对应的权重, 最长衔接词的词数)，没有可用衔接词时返回None
+    """
+    phrase_weights = {}
+    for category, sub_categories in connector_dict.items():
+        weight = connector_weights.get(CONNECTOR_CATEGORIES.get(category, category))
+        if weight is None:
+            continue
+        for connectors in sub_categories.values():
+            for connector in connectors:
+                words = tuple(connector.lower().split())
+                if all(word in vocab for word in words):
+                    phrase_weights.setdefault(words, weight)
+    if not phrase_weights:
+        return None
+    token_index = torch.zeros(len(vocab), dtype=torch.long)
+    compact = {}
+    for words in phrase_weights:
+        for word in words:
+            if word not in compact:
+                compact[word] = len(compact) + 1
+                token_index[vocab[word]] = compact[word]
+    base = len(compact) + 1
+    max_len = max(len(words) for words in phrase_weights)
+    assert base ** max_len < 2 ** 63, "too many connector words to encode"
+    codes = {}
+    for words, weight in phrase_weights.items():
+        codes[sum(compact[word] * base ** k for k, word in enumerate(words))] = weight
+    codes = sorted(codes.items())
+    return token_index, torch.tensor([code for code, _ in codes]), \
+        torch.tensor([weight for _, weight in codes], dtype=torch.float), max_len
+
+
+def essay_lengths(nonempty, num_sents, batch_size):
+    """
+    每篇作文的句子数：最后一个非空句子的位置加1，之后的句子都是填充。
+    reader.shorten_tokens可能在作文中间产生空句子，因此不能用非空句子的个数作为句子数。
+
+    :param nonempty: 形状为(num_sents * batch_size,)的布尔张量，句子优先排列
+    :return: 形状为(batch_size,)的句子数，至少为1
+    """
+    positions = torch.arange(1, num_sents + 1, device=nonempty.device).unsqueeze(1)
+    return (nonempty.view(num_sents, batch_size).long() * positions).max(0).values.clamp(min=1)
+
 
 class HierAttNet(nn.Module):
     def __init__(self, word_hidden_size, sent_hidden_size, batch_size, embed_table,
-                 max_sent_length, max_word_length, connector_dict_path):
+                 max_sent_length, max_word_length, connector_dict_path, word_chunk_size=128, vocab=None, masked=False,
+                 autocast_dtype=None, checkpoint_activations=False, connector_weighting=False):
         """
         初始化HierAttNet模型。
 
         :param word_hidden_size: 单词级别隐藏层的大小
         :param sent_hidden_size: 句子级别隐藏层的大小
-        :param batch_size: 批处理的大小
+        :param batch_size: 批处理的大小，仅为兼容保留；模型不保存任何与批次有关的状态，前向计算可接受任意批大小，
+            同一个模型可以在多个线程中同时推理（见benchmark.py threads）
         :param embed_table: 词嵌入表
         :param max_sent_length: 最大句子长度
         :param max_word_length: 最大单词长度
+        :param word_chunk_size: 单词级别注意力每次计算的句子数，None或0表示所有句子一次计算。
+            CPU上分块能让中间结果留在缓存中，见benchmark.py model
+        :param vocab: 词汇表，用于将衔接词编译为词索引；为None时不融合衔接词特征
+        :param masked: 是否忽略填充：注意力不作用于填充位置，空句子不参与单词级别计算、表示为0，
+            句子级别LSTM使用打包序列，只计算到每篇作文的最后一个非空句子
+        :param autocast_dtype: 混合精度计算的类型（如torch.bfloat16），None表示全部使用float32；参数始终为float32
+        :param checkpoint_activations: 训练时是否对单词级别注意力的每个分块和句子级别网络使用激活检查点：
+            前向计算只保留各块的输入输出，反向传播时逐块重新计算，以约1/3的额外计算换取更少的内存
+        :param connector_weighting: 是否以句首衔接词类别的权重对句子表示加权（需要vocab）。
+            原实现中该加权从未生效，默认关闭以保持原来的结果
         """
         super(HierAttNet, self).__init__()
         self.batch_size = batch_size
@@ -25,26 +100,31 @@ class HierAttNet(nn.Module):
         self.sent_hidden_size = sent_hidden_size
         self.max_sent_length = max_sent_length
         self.max_word_length = max_word_length
+        self.word_chunk_size = word_chunk_size
+        self.masked = masked
+        self.autocast_dtype = autocast_dtype
+        self.checkpoint_activations = checkpoint_activations
+        self.connector_weighting = connector_weighting
+        # 为True时masked模式不压缩空句子、不裁剪、不打包，所有张量形状只取决于输入形状，用于导出
+        self.static_shapes = False
+        # static_shapes时单词级别注意力每块包含的句子位置数，None表示一次计算
+        self.word_chunk_slots = None
         #self.prompt_id = prompt_id
 
         # 初始化单词级别注意力网络
         self.word_att_net = WordAttNet(embed_table, word_hidden_size)
         # 初始化句子级别注意力网络
         self.sent_att_net = SentAttNet(sent_hidden_size, word_hidden_size)
-
-        # 初始化隐藏状态
-        self._init_hidden_state()
         """
         # 情感特征相关
         self.load_sentiment_data()
         self.sentiment_dict = {}
         self.polarity_weights = {}
         """
-        # 加载衔接词字典
+        # 加载衔接词字典和权重，并编译为张量查找表
+        self.vocab = vocab
         self.load_connector_data(connector_dict_path)
         self.load_connector_weights()
-
-        self.connector_weights = {}  # 初始化衔接词权重映射
     """
     def load_sentiment_data(self):
         
@@ -74,71 +154,130 @@ class HierAttNet(nn.Module):
         """
         with open('connector_weights.json', 'r') as f:
             self.connector_weights = json.load(f)
+        self.compile_connectors()
+
+    def compile_connectors(self):
+        """将衔接词字典和权重编译为模型缓冲区，前向计算时只需在张量上查表"""
+        table = None
+        if self.vocab is not None:
+            table = compile_connector_table(self.connector_dict, self.connector_weights, self.vocab)
+        if table:
+            device = next(self.parameters()).device
+            token_index, codes, weights, max_len = table
+            token_index, codes, weights = token_index.to(device), codes.to(device), weights.to(device)
+        else:
+            token_index, codes, weights, max_len = None, None, None, 0
+        self.connector_max_len = max_len
+        # 紧凑编号的进制，衔接词编码为sum(编号[k] * connector_base ** k)
+        self.connector_base = int(token_index.max()) + 1 if table else 0
+        self.register_buffer('connector_token_index', token_index, persistent=False)
+        self.register_buffer('connector_codes', codes, persistent=False)
+        self.register_buffer('connector_code_weights', weights, persistent=False)
 
     def load_connector_data(self, connector_dict_path):
         # 读取衔接词字典
         with open(connector_dict_path, 'r', encoding="utf-8") as f:
             self.connector_dict = json.load(f)
 
-    def _init_hidden_state(self, last_batch_size=None):
+    def connector_sentence_weights(self, sents):
         """
-        初始化隐藏状态。如果提供了 last_batch_size，则使用该值来初始化。
+        计算每个句子的衔接词权重：句首与某个衔接词（取最长的匹配）相同时为该衔接词类别的权重，否则为1。
+        全部在张量上完成，没有主机同步。
 
-        :param last_batch_size: 上一批的大小，默认使用当前批的大小
+        :param sents: 词索引，形状为(句子长度, 句子数)
+        :return: 形状为(句子数,)的权重
         """
-        if last_batch_size:
-            batch_size = last_batch_size
-        else:
-            batch_size = self.batch_size
-        # 初始化单词级别和句子级别的隐藏状态
-        self.word_hidden_state = torch.zeros(2, batch_size, self.word_hidden_size)
-        self.sent_hidden_state = torch.zeros(2, batch_size, self.sent_hidden_size)
-        # 如果可用，移动到GPU
-        if torch.cuda.is_available():
-            self.word_hidden_state = self.word_hidden_state.cuda()
-            self.sent_hidden_state = self.sent_hidden_state.cuda()
+        max_len = min(self.connector_max_len, sents.size(0))
+        token_ids = self.connector_token_index[sents[:max_len]].t()  # 句子数 * max_len
+        powers = self.connector_base ** torch.arange(max_len, device=sents.device)
+        prefix_codes = (token_ids * powers).cumsum(1)  # 句首前n个词的编码
+        positions = torch.searchsorted(self.connector_codes, prefix_codes).clamp(max=self.connector_codes.size(0) - 1)
+        matched = self.connector_codes[positions] == prefix_codes
+        # 取最长的匹配
+        lengths = torch.arange(1, max_len + 1, device=sents.device)
+        longest = (matched.long() * lengths).max(1).values
+        weights = self.connector_code_weights[positions.gather(1, (longest - 1).clamp(min=0).unsqueeze(1)).squeeze(1)]
+        return torch.where(longest > 0, weights, torch.ones_like(weights))
 
     def forward(self, input):
         """
-        前向传播函数。
-        :param input: 输入数据，预期形状为 (batch_size, max_sent_length, max_word_length, input_dim)
-        :return: 模型输出
+        前向传播函数，不修改模型的任何属性。
+        :param input: 词索引，形状为 (batch_size, 句子数, 句子长度)
+        :return: 模型输出，始终为float32
         """
-        # 初始化一个空列表来存储每个句子的输出
-        outputs = []
-        # 调整输入数据的维度
-        input = input.permute(1, 0, 2)
-        # 对每一个句子进行单词级别注意力计算
-        for i in input:
-            output = self.word_att_net(i.permute(1, 0))
-            """
-            # 考虑情感特征的权重
-            for j in range(output.size(0)):
-                # 获取单词的张量
-                word_tensor = i[j]
-                # 将张量转换为标量
-                word = word_tensor.argmax().item()  # 选择最大值对应的索引作为单词的表示
-                # 检查情感字典中是否存在该单词
-                if word in self.sentiment_dict:
-                    polarity_value, _ = self.sentiment_dict[word]
-                    if polarity_value in self.polarity_weights:
-                        weight = self.polarity_weights[polarity_value]
-                        output[j] *= weight
-            """
-
-            # 融合衔接词特征
-            for j in range(output.size(0)):
-                word_tensor = i[j]
-                word = word_tensor.argmax().item()
-                if word in self.connector_dict:
-                    connector_category = self.connector_dict[word]
-                    if connector_category in self.connector_weights:
-                        weight = self.connector_weights[connector_category]
-                        output[j] *= weight
-
-            outputs.append(output)
-
-        output_list = torch.cat(outputs, dim=0)
+        if self.autocast_dtype is None:
+            return self.hierarchical_attention(input)
+        with torch.autocast(device_type=input.device.type, dtype=self.autocast_dtype):
+            output = self.hierarchical_attention(input)
+        return output.float()
+
+    def hierarchical_attention(self, input):
+        """单词级别和句子级别注意力计算"""
+        batch_size, num_sents, sent_length = input.size()
+        # 句子优先排列后展平为(num_sents * batch_size, sent_length)，一次完成所有句子的单词级别注意力计算
+        sents = input.permute(1, 0, 2).reshape(num_sents * batch_size, sent_length).permute(1, 0)
+        if self.static_shapes:
+            word_mask = sents != 0 if self.masked else None
+            sent_lengths = essay_lengths(word_mask.any(0), num_sents, batch_size) if self.masked else None
+            output = self.slot_word_attention(sents, word_mask, num_sents)
+            if self.masked:
+                # 与动态形状时一致，作文中间的空句子表示为0
+                output = output * word_mask.any(0).unsqueeze(1).to(output.dtype)
+        elif self.masked:
+            word_mask = sents != 0
+            nonempty = word_mask.any(0)
+            sent_lengths = essay_lengths(nonempty, num_sents, batch_size)
+            # 去掉整批都是填充的句尾，至少保留一个卷积窗口
+            kernel_size = self.word_att_net.conv1.kernel_size[0]
+            trimmed = min(max(int(word_mask.any(1).sum()), kernel_size), sent_length)
+            sents, word_mask = sents[:trimmed], word_mask[:trimmed]
+            # 只计算非空句子，空句子的表示为0，在句子级别被忽略
+            index = nonempty.nonzero().squeeze(1)
+            word_output = self.word_attention(sents[:, index], word_mask[:, index])
+            output = word_output.new_zeros(1, sents.size(1), word_output.size(2))
+            output[:, index] = word_output
+        else:
+            sent_lengths = None
+            output = self.word_attention(sents)
+        # 恢复为(num_sents, batch_size, hidden_size)，与逐句计算后按句子拼接的结果一致
+        output = output.view(num_sents, batch_size, -1)
+
+        # 融合衔接词特征：以句首衔接词类别的权重对句子表示加权
+        if self.connector_weighting and self.connector_codes is not None:
+            output = output * self.connector_sentence_weights(sents).view(num_sents, batch_size, 1)
+
         # 对整个句子集合进行句子级别注意力计算
-        output = self.sent_att_net(output_list)
+        output = self.checkpointed(self.sent_att_net, output, sent_lengths, not self.static_shapes)
         return output
+
+    def checkpointed(self, module, *args):
+        """调用子网络；启用激活检查点且需要计算梯度时，不保存子网络内部的中间结果，反向传播时重新计算"""
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            # 重新计算时恢复随机数状态，dropout的结果与第一次计算相同
+            return checkpoint(module, *args, use_reentrant=False)
+        return module(*args)
+
+    def slot_word_attention(self, sents, mask, num_sents):
+        """
+        按句子位置分块计算单词级别注意力，每块包含word_chunk_slots个句子位置的所有作文。用于导出：
+        追踪时块的划分被固定下来，它只取决于句子数，因此导出的模型对任意批大小都正确。
+        """
+        slots = self.word_chunk_slots or num_sents
+        sent_length = sents.size(0)
+        sents = sents.view(sent_length, num_sents, -1)
+        mask = None if mask is None else mask.view(sent_length, num_sents, -1)
+        outputs = []
+        for start in range(0, num_sents, slots):
+            chunk = sents[:, start:start + slots].reshape(sent_length, -1)
+            chunk_mask = None if mask is None else mask[:, start:start + slots].reshape(sent_length, -1)
+            outputs.append(self.word_att_net(chunk, chunk_mask))
+        return torch.cat(outputs, dim=1)
+
+    def word_attention(self, sents, mask=None):
+        """对形状为(句子长度, 句子数)的词索引计算单词级别注意力，按word_chunk_size分块"""
+        if self.word_chunk_size and sents.size(1) > self.word_chunk_size:
+            # 各句子的计算互相独立，分块计算的结果与一次计算相同
+            masks = mask.split(self.word_chunk_size, dim=1) if mask is not None else [None] * sents.size(1)
+            return torch.cat([self.checkpointed(self.word_att_net, chunk, chunk_mask) for chunk, chunk_mask
+                              in zip(sents.split(self.word_chunk_size, dim=1), masks)], dim=1)
+        return self.checkpointed(self.word_att_net, sents, mask)
@@ -0,0 +1,101 @@
+"""
+加载export.py导出的模型进行评分，只依赖torch、numpy和vocab.py，不需要训练代码。
+
+用法示例：
+scorer = ExportedScorer('net.ts')
+scores = scorer.score([[['this', 'is', 'an', 'essay', '.'], ['however', ',', 'it', 'is', 'short', '.']]])
+# 所有题目联合训练的模型需给出每篇作文的题目
+scores = scorer.score(essays, prompt_ids=[1, 2])
+
+作文需使用与训练时相同的标记化设置（分词后端和流程，见scorer.tokenization）标记化，例如：
+reader.set_tokenization(scorer.tokenization['tokenizer'], scorer.tokenization['single_pass'])
+"""
+import json
+import numpy as np
+import torch
+from vocab import Vocab
+
+# 导出文件中元数据的文件名，与export.py一致
+METADATA_FILE = 'metadata.json'
+
+
+def load_exported(model_path, device='cpu'):
+    """加载导出的TorchScript模型，返回(模块, 元数据)"""
+    extra_files = {METADATA_FILE: ''}
+    module = torch.jit.load(model_path, map_location=device, _extra_files=extra_files)
+    module.eval()
+    return module, json.loads(extra_files[METADATA_FILE])
+
+
+class ExportedScorer(object):
+    def __init__(self, model_path, device='cpu', tokenization=None):
+        """
+        导出模型的评分器：编码、填充并评分已标记化的作文。
+
+        :param model_path: export.py导出的文件
+        :param device: 运行设备
+        :param tokenization: 可选，调用方标记化作文时使用的设置（reader.tokenization_settings()）；
+            与导出文件记录的训练时设置不同时抛出ValueError
+        """
+        self.device = device
+        self.module, self.metadata = load_exported(model_path, device)
+        self.vocab = Vocab(self.metadata['vocab'])
+        self.max_sentnum = self.metadata['max_sentnum']
+        self.max_sentlen = self.metadata['max_sentlen']
+        self.min_sentlen = self.metadata['min_sentlen']
+        # 训练时的标记化设置，旧版本导出的文件没有记录
+        self.tokenization = self.metadata.get('tokenization')
+        if tokenization is not None and self.tokenization is not None and dict(tokenization) != self.tokenization:
+            raise ValueError('the model was trained with tokenization %s, but essays are tokenized with %s'
+                             % (self.tokenization, dict(tokenization)))
+        self.prompt_id = self.metadata['prompt_id']
+        # 旧版本导出的文件只有单个提示的score_range
+        score_ranges = self.metadata.get('score_ranges', {str(self.prompt_id): self.metadata.get('score_range')})
+        self.score_ranges = dict((int(prompt), score_range) for prompt, score_range in score_ranges.items())
+
+    def pad(self, essays):
+        """
+        将作文的词索引截断到最大形状后填充。导出模型要求句子数为max_sentnum；masked模型的输出与句子长度的填充量无关，
+        只填充到本批的最长句子，否则与训练时一样填充到max_sentlen。
+        """
+        essays = [[sent[:self.max_sentlen] for sent in essay[:self.max_sentnum]] for essay in essays]
+        if self.metadata['masked']:
+            sentlen = max([len(sent) for essay in essays for sent in essay] + [self.min_sentlen])
+        else:
+            sentlen = self.max_sentlen
+        X = np.zeros([len(essays), self.max_sentnum, sentlen], dtype=np.int64)
+        for i, essay in enumerate(essays):
+            for j, sent in enumerate(essay):
+                X[i, j, :len(sent)] = sent
+        return torch.from_numpy(X)
+
+    def predict(self, input):
+        """对(batch, 句子数, 句子长度)的词索引张量计算0-1范围的模型分数"""
+        with torch.no_grad():
+            return self.module(input.to(self.device)).view(-1).cpu()
+
+    def score_range_arrays(self, prompt_ids, num_essays):
+        """返回每篇作文的(最低分, 最高分)数组；prompt_ids为None时使用导出时的提示ID"""
+        if prompt_ids is None:
+            if self.prompt_id <= 0:
+                raise ValueError('the model was trained on all prompts jointly, pass prompt_ids')
+            prompt_ids = [self.prompt_id] * num_essays
+        if len(prompt_ids) != num_essays:
+            raise ValueError('got %d prompt ids for %d essays' % (len(prompt_ids), num_essays))
+        unknown = set(int(prompt) for prompt in prompt_ids) - set(self.score_ranges)
+        if unknown:
+            raise ValueError('no score range for prompts %s' % sorted(unknown))
+        ranges = np.array([self.score_ranges[int(prompt)] for prompt in prompt_ids], dtype=np.float32).reshape(-1, 2)
+        return ranges[:, 0], ranges[:, 1]
+
+    def score(self, essays, prompt_ids=None):
+        """
+        对已标记化并小写化的作文评分。
+
+        :param essays: 作文列表，每篇作文是句子标记列表的列表
+        :param prompt_ids: 可选，每篇作文的提示ID，按各自提示的分数范围还原分数；所有提示联合训练的模型必须给出
+        :return: 数据集范围内的分数数组
+        """
+        lows, highs = self.score_range_arrays(prompt_ids, len(essays))
+        input = self.pad([self.vocab.encode(essay)[0] for essay in essays])
+        return self.predict(input).numpy() * (highs - lows) + lows
@@ -0,0 +1,113 @@
+"""
+对train.py保存的模型做动态int8量化（LSTM和全连接层），用于CPU评分。
+
+评估数据使用模型记录的训练时标记化设置（分词后端和流程）重新标记化；旧版本的模型没有记录时使用--tokenizer。
+量化后在留出的一折数据上比较QWK，下降超过--tolerance时不保存量化模型并以非零状态退出；同时输出量化前后的模型大小和每篇作文的延迟。
+--prompt_id <= 0时（所有提示联合训练的模型）按每篇作文的提示还原分数，比较各提示QWK的平均值，与train.py的评估一致。
+
+用法示例：
+python quantize.py --model net_fold0.pt --datapath data/fold_ --fold 0 --prompt_id 1 --output net_int8.pkl
+"""
+import argparse
+import io
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import reader
+import utils
+from metrics import quadratic_weighted_kappa
+from checkpoint import load_model
+
+# 初始化日志记录器
+logger = utils.get_logger("Quantize model ...")
+
+
+def quantize_model(model):
+    """对LSTM和全连接层做动态int8量化，返回新的模型"""
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def model_size(model):
+    """模型参数序列化后的字节数"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def load_fold(file_path, prompt_id, vocab, max_sentnum, max_sentlen):
+    """读取一折数据，截断并填充到模型的最大形状，返回(词索引张量, 原始分数, 每篇作文的提示ID)"""
+    data_x, data_y, prompt_ids, _, _ = reader.read_dataset(file_path, prompt_id, vocab, True)
+    data_x = [[sent[:max_sentlen] for sent in essay[:max_sentnum]] for essay in data_x]
+    X, _, _ = utils.padding_sentence_sequences(data_x, data_y, max_sentnum, max_sentlen, dtype=np.int64)
+    return torch.from_numpy(X), np.array(data_y), np.array(prompt_ids)
+
+
+def evaluate(model, X, y, prompt_ids, batch_size):
+    """返回(各提示QWK的平均值, {提示ID: QWK}, 每篇作文的平均延迟秒数)"""
+    predictions = []
+    start = time.time()
+    with torch.no_grad():
+        for i in range(0, len(X), batch_size):
+            predictions.append(model(X[i:i + batch_size]).view(-1).numpy())
+    elapsed = time.time() - start
+    predictions = reader.convert_to_dataset_friendly_scores(np.concatenate(predictions), prompt_ids)
+    prompt_qwks = dict((int(prompt), quadratic_weighted_kappa(predictions[prompt_ids == prompt], y[prompt_ids == prompt]))
+                       for prompt in np.unique(prompt_ids))
+    return np.mean(list(prompt_qwks.values())), prompt_qwks, elapsed / len(X)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dynamic int8 quantization of a trained HierAttNet")
+    parser.add_argument('--model', type=str, default='net_fold0.pt', help='Model saved by train.py')
+    parser.add_argument('--vocab', type=str, default=None, help='Vocabulary file, defaults to the one stored in the model')
+    parser.add_argument('--datapath', type=str, default='data/fold_', help='Base path for data')
+    parser.add_argument('--fold', type=int, default=0, help='Fold whose test set is used for the check')
+    parser.add_argument('--prompt_id', type=int, required=True, help='Prompt ID of the essay set, <= 0 for all prompts')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Largest allowed QWK drop')
+    parser.add_argument('--batch_size', type=int, default=10, help='Batch size for the check')
+    parser.add_argument('--output', type=str, required=True, help='Output path of the quantized model')
+    parser.add_argument('--tokenizer', choices=['nltk', 'regex'], default=None,
+                        help='Word tokenizer backend, defaults to the one recorded in the model')
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    model = load_model(args.model)
+    # 按训练时的标记化设置重新标记化评估数据
+    if model.tokenization is not None:
+        if args.tokenizer and args.tokenizer != model.tokenization['tokenizer']:
+            parser.error('the model was trained with the %s tokenizer, not %s'
+                         % (model.tokenization['tokenizer'], args.tokenizer))
+        reader.set_tokenization(model.tokenization['tokenizer'], model.tokenization['single_pass'])
+    elif args.tokenizer:
+        reader.set_tokenizer_backend(args.tokenizer)
+    try:
+        reader.check_tokenizer_data()
+    except LookupError as error:
+        parser.error(str(error))
+    vocab = reader.load_vocab(args.vocab) if args.vocab else model.vocab
+    assert vocab is not None, "the model has no vocabulary, pass --vocab"
+    X, y, prompt_ids = load_fold(args.datapath + str(args.fold) + '/test.tsv', args.prompt_id, vocab,
+                     model.max_sent_length, model.max_word_length)
+
+    quantized = quantize_model(model)
+    qwk, prompt_qwks, latency = evaluate(model, X, y, prompt_ids, args.batch_size)
+    quantized_qwk, quantized_prompt_qwks, quantized_latency = evaluate(quantized, X, y, prompt_ids, args.batch_size)
+    if len(prompt_qwks) > 1:
+        for prompt in sorted(prompt_qwks):
+            logger.info('prompt %d: QWK float32 %.4f, int8 %.4f' % (prompt, prompt_qwks[prompt], quantized_prompt_qwks[prompt]))
+    size, quantized_size = model_size(model), model_size(quantized)
+    logger.info('float32: QWK %.4f, %.2f ms/essay, %.2f MB' % (qwk, 1000 * latency, size / 2. ** 20))
+    logger.info('int8:    QWK %.4f, %.2f ms/essay, %.2f MB' % (quantized_qwk, 1000 * quantized_latency,
+                                                               quantized_size / 2. ** 20))
+    if qwk - quantized_qwk > args.tolerance:
+        logger.info('QWK dropped by %.4f, more than the tolerance %.4f; not saving' % (qwk - quantized_qwk, args.tolerance))
+        return 1
+    torch.save(quantized, args.output)
+    logger.info('Saved quantized model to ' + args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
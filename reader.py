@@ -1,21 +1,32 @@
 import random
 import codecs
 import sys
-import nltk
+try:
+    import nltk
+except ImportError:
+    # 推理环境可以不安装nltk，使用fast_tokenizer分词
+    nltk = None
 # import logging
 import re
 import numpy as np
 import pickle as pk
 import utils
+import fast_tokenizer
+from vocab import Vocab, num_regex
 import pandas as pd
 import csv
+import math
+import os
+import hashlib
+from functools import partial
+from multiprocessing import Pool
 
 # 用于替换URL的占位符
 url_replacer = '<url>'
+# 匹配URL的正则表达式
+url_regex = '(http[s]?://)?((www)\.)?([a-zA-Z0-9]+)\.{1}((com)(\.(cn))?|(org))'
 # 初始化日志记录器
 logger = utils.get_logger("Loading data...")
-# 正则表达式用于匹配数字
-num_regex = re.compile('^[+-]?[0-9]+\.?[0-9]*$')
 # 参考分数数据类型
 ref_scores_dtype = 'int32'
 # 各个prompt的高分值设定
@@ -25,6 +36,18 @@ high_score = [0, 10, 5, 3, 3, 3, 3, 24, 48]
 MAX_SENTLEN = 50
 MAX_SENTNUM = 100
 
+# 标记化缓存格式版本，缓存内容或标记化逻辑变化时递增
+TOKEN_CACHE_VERSION = 3
+
+# 分词后端：'nltk'使用nltk.word_tokenize，'regex'使用不依赖nltk的fast_tokenizer
+TOKENIZER_BACKENDS = ('nltk', 'regex')
+TOKENIZER_BACKEND = 'nltk' if nltk is not None else 'regex'
+
+# 是否使用单次标记化流程（tokens_to_sentences）。默认使用旧流程：整篇分词后拼回字符串，分句后逐句重新分词；
+# 单次流程不再逐句重新分词，在句号与引号或缩写相连的句子上可能与旧流程不同，
+# 只有benchmark.py tokenize在实际数据上没有差异时才应启用
+SINGLE_PASS_TOKENIZATION = False
+
 # ASAP数据集各个prompt对应的分数范围
 asap_ranges = {
     0: (0, 60),
@@ -42,9 +65,76 @@ def get_ref_dtype():
     """获取参考分数的数据类型"""
     return ref_scores_dtype
 
+def set_tokenizer_backend(backend):
+    """选择分词后端，可选'nltk'或'regex'"""
+    global TOKENIZER_BACKEND
+    if backend not in TOKENIZER_BACKENDS:
+        raise ValueError("tokenizer backend should choose from %s" % (TOKENIZER_BACKENDS,))
+    if backend == 'nltk' and nltk is None:
+        raise ImportError("nltk is not installed, use the 'regex' tokenizer backend instead")
+    TOKENIZER_BACKEND = backend
+
+
+def set_single_pass_tokenization(enabled):
+    """选择分句后是否使用单次标记化流程，见SINGLE_PASS_TOKENIZATION"""
+    global SINGLE_PASS_TOKENIZATION
+    SINGLE_PASS_TOKENIZATION = bool(enabled)
+
+
+def set_tokenization(backend, single_pass):
+    """同时设置分词后端和单次标记化流程，用作进程池的初始化函数"""
+    set_tokenizer_backend(backend)
+    set_single_pass_tokenization(single_pass)
+
+
+def check_tokenizer_data():
+    """确认当前分词后端可用：nltk后端需要punkt数据，缺少时抛出带下载说明的LookupError"""
+    if TOKENIZER_BACKEND != 'nltk':
+        return
+    try:
+        nltk.word_tokenize('A test. Another test.')
+    except LookupError:
+        raise LookupError("nltk is installed without its punkt data: run 'python -m nltk.downloader punkt_tab'. "
+                          "Switching to the regex backend changes the tokens unless the model was trained with it")
+
+
+def tokenization_settings():
+    """当前的标记化设置，写入词表、模型和导出文件的元数据，加载时用check_tokenization检查"""
+    return {'tokenizer': TOKENIZER_BACKEND, 'single_pass': SINGLE_PASS_TOKENIZATION}
+
+
+def check_tokenization(recorded, name):
+    """
+    检查文件记录的标记化设置与当前设置一致。不同的分词后端或流程得到的标记不同，词表和模型输入会随之改变。
+    旧版本的文件没有记录（recorded为None）时不检查。
+    """
+    if recorded is not None and dict(recorded) != tokenization_settings():
+        raise ValueError('%s was built with tokenization %s, but the current settings are %s; '
+                         'call reader.set_tokenization(%r, %r) first'
+                         % (name, recorded, tokenization_settings(), recorded['tokenizer'], recorded['single_pass']))
+
+
+def word_tokenize(string):
+    """使用当前的分词后端对字符串分词"""
+    if TOKENIZER_BACKEND == 'regex':
+        return fast_tokenizer.word_tokenize(string)
+    return nltk.word_tokenize(string)
+
+
+def word_tokenize_batch(strings):
+    """使用当前的分词后端批量分词"""
+    if TOKENIZER_BACKEND == 'regex':
+        return fast_tokenizer.tokenize_batch(strings)
+    return [nltk.word_tokenize(string) for string in strings]
+
+
 def tokenize(string):
     """对输入字符串进行标记化处理，处理'@'符号后的数字"""
-    tokens = nltk.word_tokenize(string)
+    return merge_at_tokens(word_tokenize(string))
+
+
+def merge_at_tokens(tokens):
+    """将'@'与其后的匿名化标记合并，并去掉标记中的数字，如'@', 'CAPS1' -> '@CAPS'"""
     for index, token in enumerate(tokens):
         if token == '@' and (index + 1) < len(tokens):
             tokens[index + 1] = '@' + re.sub('[0-9]+.*', '', tokens[index + 1])
@@ -55,62 +145,40 @@ def get_score_range(prompt_id):
     """根据prompt_id返回对应的分数范围"""
     return asap_ranges[prompt_id]
 
-def get_model_friendly_scores(scores_array, prompt_id_array):
-    """将原始分数转换为0-1范围的模型友好分数"""
-    for k, i in enumerate(prompt_id_array):
-        if i == 1:
-            minscore = 2
-            maxscore = 12
-        elif i == 2:
-            minscore = 1
-            maxscore = 6
-        elif i in [3, 4]:
-            minscore = 0
-            maxscore = 3
-        elif i in [5, 6]:
-            minscore = 0
-            maxscore = 4
-        elif i == 7:
-            minscore = 0
-            maxscore = 30
-        elif i == 8:
-            minscore = 0
-            maxscore = 60
-        else:
-            minscore = 1
-            maxscore = 3
+def prompt_score_ranges(prompt_id_array, num_scores, dtype=np.float64):
+    """
+    返回每篇作文所属提示的最低分和最高分数组。提示1-8为ASAP的分数范围，其余提示为(1, 3)。
+
+    :param prompt_id_array: 每篇作文的提示ID，或所有作文共同的一个提示ID
+    :param num_scores: 作文数
+    """
+    lows = np.ones(9, dtype=dtype)
+    highs = np.full(9, 3, dtype=dtype)
+    for prompt in range(1, 9):
+        lows[prompt], highs[prompt] = utils.asap_ranges[prompt]
+    prompt_ids = np.broadcast_to(np.asarray(prompt_id_array, dtype=np.int64), (num_scores,))
+    # 超出1-8的提示ID映射到位置0，即(1, 3)
+    prompt_ids = np.where((prompt_ids >= 1) & (prompt_ids <= 8), prompt_ids, 0)
+    return lows[prompt_ids], highs[prompt_ids]
 
-        scores_array[k] = (scores_array[k] - minscore) / (maxscore - minscore)
+
+def get_model_friendly_scores(scores_array, prompt_id_array):
+    """将原始分数按各作文所属提示的分数范围转换为0-1范围的模型友好分数（原地修改并返回）"""
+    lows, highs = prompt_score_ranges(prompt_id_array, len(scores_array), scores_array.dtype)
+    shape = (-1,) + (1,) * (scores_array.ndim - 1)
+    scores_array[...] = (scores_array - lows.reshape(shape)) / (highs - lows).reshape(shape)
     return scores_array
 
 def convert_to_dataset_friendly_scores(scores_array, prompt_id_array):
-    """将模型友好分数转换为数据集友好分数"""
-    i = prompt_id_array
-    if i == 1:
-        minscore = 2
-        maxscore = 12
-    elif i == 2:
-        minscore = 1
-        maxscore = 6
-    elif i in [3, 4]:
-        minscore = 0
-        maxscore = 3
-    elif i in [5, 6]:
-        minscore = 0
-        maxscore = 4
-    elif i == 7:
-        minscore = 0
-        maxscore = 30
-    elif i == 8:
-        minscore = 0
-        maxscore = 60
-    else:
-        minscore = 1
-        maxscore = 3
+    """
+    将模型友好分数转换为数据集友好分数。
 
-    for k, i in enumerate(scores_array):
-        scores_array[k] = scores_array[k] * (maxscore - minscore) + minscore
-    return np.round(scores_array)
+    :param prompt_id_array: 所有作文共同的提示ID，或每篇作文的提示ID（多提示联合训练）
+    """
+    scores_array = np.asarray(scores_array)
+    lows, highs = prompt_score_ranges(prompt_id_array, len(scores_array), scores_array.dtype)
+    shape = (-1,) + (1,) * (scores_array.ndim - 1)
+    return np.round(scores_array * (highs - lows).reshape(shape) + lows.reshape(shape))
 
 def is_number(token):
     """判断标记是否为数字"""
@@ -118,39 +186,40 @@ def is_number(token):
 
 
 def load_vocab(vocab_path):
-    """从指定路径加载词汇表"""
+    """
+    从指定路径加载词汇表，支持Vocab.save保存的二进制词表和pickle保存的字典。
+    二进制词表记录了建立时的标记化设置，与当前设置不同时抛出ValueError。
+    """
     logger.info('Loading vocabulary from: ' + vocab_path)
+    if Vocab.is_vocab_file(vocab_path):
+        vocab = Vocab.load(vocab_path)
+        check_tokenization(vocab.tokenization, vocab_path)
+        return vocab
     with open(vocab_path, 'rb') as vocab_file:
         vocab = pk.load(vocab_file)
     return vocab
 
 
-def create_vocab(file_path, prompt_id, vocab_size, tokenize_text, to_lower):
-    """创建词汇表"""
+def create_vocab(file_path, prompt_id, vocab_size, tokenize_text, to_lower, num_workers=1, cache_dir=None):
+    """创建词汇表，num_workers>1时并行标记化，cache_dir不为空时使用标记化缓存"""
     logger.info('Creating vocabulary from: ' + file_path)
     total_words, unique_words = 0, 0
     word_freqs = {}
-    with codecs.open(file_path, mode='r', encoding='UTF8') as input_file:
-        input_file.readline()
-        for line in input_file:
-            tokens = line.strip().split('\t')
-            essay_id = int(tokens[0])
-            essay_set = int(tokens[1])
-            content = tokens[2].strip()
-            score = float(tokens[6])
-            # print(tokens, essay_id, essay_set, content, score)
-            if essay_set == prompt_id or prompt_id <= 0:
-                if tokenize_text:
-                    content = text_tokenizer(content, True, True, True)
-                if to_lower:
-                    content = [w.lower() for w in content]
-                for word in content:
-                    try:
-                        word_freqs[word] += 1
-                    except KeyError:
-                        unique_words += 1
-                        word_freqs[word] = 1
-                    total_words += 1
+    if tokenize_text:
+        _, contents = load_tokenized_essays(file_path, prompt_id, to_lower, create_vocab_flag=True, skip_header=True,
+                                            num_workers=num_workers, cache_dir=cache_dir)
+    else:
+        contents = [content for _, _, content, _ in read_tsv_rows(file_path, prompt_id, skip_header=True)]
+        if to_lower:
+            contents = [[w.lower() for w in content] for content in contents]
+    for content in contents:
+        for word in content:
+            try:
+                word_freqs[word] += 1
+            except KeyError:
+                unique_words += 1
+                word_freqs[word] = 1
+            total_words += 1
     logger.info('  %i total words, %i unique words' % (total_words, unique_words))
     import operator
     sorted_word_freqs = sorted(word_freqs.items(), key=operator.itemgetter(1), reverse=True)
@@ -171,6 +240,157 @@ def create_vocab(file_path, prompt_id, vocab_size, tokenize_text, to_lower):
     return vocab
 
 
+def iter_tsv_rows(file_path, prompt_id, score_index=6, skip_header=False):
+    """逐行读取TSV文件，产出属于指定prompt的(essay_id, essay_set, content, score)"""
+    with codecs.open(file_path, mode='r', encoding='UTF8') as input_file:
+        if skip_header:
+            input_file.readline()
+        for line in input_file:
+            tokens = line.strip().split('\t')
+            essay_id = int(tokens[0])
+            essay_set = int(tokens[1])
+            content = tokens[2].strip()
+            score = float(tokens[score_index])
+            if essay_set == prompt_id or prompt_id <= 0:
+                yield essay_id, essay_set, content, score
+
+
+def read_tsv_rows(file_path, prompt_id, score_index=6, skip_header=False):
+    """读取TSV文件中属于指定prompt的行，返回(essay_id, essay_set, content, score)列表"""
+    return list(iter_tsv_rows(file_path, prompt_id, score_index, skip_header))
+
+
+def tokenize_batch(contents, create_vocab_flag=False):
+    """批量标记化作文，结果与逐篇调用text_tokenizer相同"""
+    texts = [clean_text(content) for content in contents]
+    return [essay_tokens_to_sentences(merge_at_tokens(tokens), create_vocab_flag)
+            for tokens in word_tokenize_batch(texts)]
+
+
+def tokenize_essays(contents, num_workers=1, create_vocab_flag=False):
+    """
+    对作文列表进行标记化处理，返回与输入顺序一致的结果。
+
+    num_workers>1 时将作文分块后交给进程池并行处理，输出与顺序处理完全相同。
+    """
+    if num_workers is None or num_workers <= 1 or len(contents) < 2:
+        return tokenize_batch(contents, create_vocab_flag)
+    # 每个进程分到若干块，块不宜过大以便负载均衡
+    chunksize = max(1, int(math.ceil(len(contents) / float(num_workers * 4))))
+    chunks = [contents[i:i + chunksize] for i in range(0, len(contents), chunksize)]
+    with Pool(processes=num_workers, initializer=set_tokenization,
+              initargs=(TOKENIZER_BACKEND, SINGLE_PASS_TOKENIZATION)) as pool:
+        results = pool.map(partial(tokenize_batch, create_vocab_flag=create_vocab_flag), chunks)
+    return [essay for chunk in results for essay in chunk]
+
+
+def _file_digest(file_path):
+    """计算文件内容的SHA1摘要"""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def token_cache_path(cache_dir, file_path, prompt_id, to_lower, create_vocab_flag=False, skip_header=False):
+    """
+    根据文件内容和标记化设置生成缓存文件路径。
+
+    键包含文件摘要、prompt、MAX_SENTLEN、小写化、URL替换设置、分词后端和是否使用单次标记化流程，任意一项变化都会得到新的缓存文件。
+    """
+    key = '|'.join([
+        _file_digest(file_path),
+        'version=%d' % TOKEN_CACHE_VERSION,
+        'prompt=%d' % prompt_id,
+        'header=%s' % skip_header,
+        'max_sentlen=%d' % MAX_SENTLEN,
+        'lower=%s' % to_lower,
+        'url=%s=>%s' % (url_regex, url_replacer),
+        'vocab_flag=%s' % create_vocab_flag,
+        'tokenizer=%s' % TOKENIZER_BACKEND,
+        'single_pass=%s' % SINGLE_PASS_TOKENIZATION,
+    ])
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(cache_dir, '%s.%s.npz' % (name, hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+
+def save_token_cache(cache_path, essays_tokens):
+    """
+    将标记化后的作文保存为紧凑的二进制格式。
+
+    所有词写入一个以换行分隔的UTF-8字节块，作文以词编号数组加句子长度、句子数量数组表示。
+    """
+    word_ids = {}
+    ids, sent_lens, sent_nums = [], [], []
+    for sents in essays_tokens:
+        sent_nums.append(len(sents))
+        for sent in sents:
+            sent_lens.append(len(sent))
+            ids.extend([word_ids.setdefault(w, len(word_ids)) for w in sent])
+    words = np.frombuffer('\n'.join(word_ids).encode('utf-8'), dtype=np.uint8)
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # 先写临时文件再替换，避免并发或中断时留下不完整的缓存
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, words=words, ids=np.array(ids, dtype=np.uint32),
+                 sent_lens=np.array(sent_lens, dtype=np.uint32), sent_nums=np.array(sent_nums, dtype=np.uint32))
+    os.replace(tmp_path, cache_path)
+
+
+def load_token_cache(cache_path):
+    """从缓存文件读取标记化后的作文，返回每篇作文的句子标记列表"""
+    with np.load(cache_path) as data:
+        words = data['words'].tobytes().decode('utf-8').split('\n')
+        tokens = [words[i] for i in data['ids'].tolist()]
+        sent_lens = data['sent_lens'].tolist()
+        sent_nums = data['sent_nums'].tolist()
+    essays_tokens = []
+    token_pos, sent_pos = 0, 0
+    for num in sent_nums:
+        sents = []
+        for length in sent_lens[sent_pos:sent_pos + num]:
+            sents.append(tokens[token_pos:token_pos + length])
+            token_pos += length
+        sent_pos += num
+        essays_tokens.append(sents)
+    return essays_tokens
+
+
+def load_tokenized_essays(file_path, prompt_id, to_lower, create_vocab_flag=False, skip_header=False, score_index=6,
+                          num_workers=1, cache_dir=None):
+    """
+    读取TSV文件并标记化其中的作文，cache_dir不为空时优先读取缓存。
+
+    :return: (rows, essays_tokens)，rows为read_tsv_rows的结果；create_vocab_flag为True时每篇作文是一个词列表，
+             否则为句子标记列表
+    """
+    rows = read_tsv_rows(file_path, prompt_id, score_index, skip_header)
+    cache_path = None
+    if cache_dir:
+        cache_path = token_cache_path(cache_dir, file_path, prompt_id, to_lower, create_vocab_flag, skip_header)
+        if os.path.exists(cache_path):
+            logger.info('  Loading tokenized essays from cache: ' + cache_path)
+            essays_tokens = load_token_cache(cache_path)
+            if create_vocab_flag:
+                essays_tokens = [sents[0] for sents in essays_tokens]
+            return rows, essays_tokens
+
+    essays_tokens = tokenize_essays([content for _, _, content, _ in rows], num_workers, create_vocab_flag)
+    if to_lower:
+        if create_vocab_flag:
+            essays_tokens = [[w.lower() for w in content] for content in essays_tokens]
+        else:
+            essays_tokens = [[[w.lower() for w in s] for s in sent_tokens] for sent_tokens in essays_tokens]
+    if cache_path:
+        # 词表模式下每篇作文是一个词列表，按单句作文保存
+        save_token_cache(cache_path, [[content] for content in essays_tokens] if create_vocab_flag else essays_tokens)
+        logger.info('  Saved tokenized essays to cache: ' + cache_path)
+    return rows, essays_tokens
+
+
 def read_essays(file_path, prompt_id):
     """读取TSV文件中的作文，并返回作文列表及其ID"""
     logger.info('Reading tsv from: ' + file_path)
@@ -188,12 +408,12 @@ def read_essays(file_path, prompt_id):
 
 def replace_url(text):
     """替换文本中的URL为占位符"""
-    replaced_text = re.sub('(http[s]?://)?((www)\.)?([a-zA-Z0-9]+)\.{1}((com)(\.(cn))?|(org))', url_replacer, text)
+    replaced_text = re.sub(url_regex, url_replacer, text)
     return replaced_text
 
 
-def text_tokenizer(text, replace_url_flag=True, tokenize_sent_flag=True, create_vocab_flag=False):
-    """对文本进行标记化处理，返回处理后的句子标记"""
+def clean_text(text):
+    """标记化前的文本预处理：替换URL、去掉双引号、合并重复的省略号/问号/感叹号"""
     text = replace_url(text)
     text = text.replace(u'"', u'')
     if "..." in text:
@@ -205,24 +425,22 @@ def text_tokenizer(text, replace_url_flag=True, tokenize_sent_flag=True, create_
     if "!!" in text:
         text = re.sub(r'\!{2,}(\s+\!{2,})*', '!', text)
         # print text
+    return text
+
+
+def text_tokenizer(text, replace_url_flag=True, tokenize_sent_flag=True, create_vocab_flag=False):
+    """对文本进行标记化处理，返回处理后的句子标记"""
+    text = clean_text(text)
 
-    # TODO here
     tokens = tokenize(text)
     if tokenize_sent_flag:
-        text = " ".join(tokens)
-        sent_tokens = tokenize_to_sentences(text, MAX_SENTLEN, create_vocab_flag)
-        # print sent_tokens
-        # sys.exit(0)
-        # if not create_vocab_flag:
-        #     print "After processed and tokenized, sentence num = %s " % len(sent_tokens)
-        return sent_tokens
+        return essay_tokens_to_sentences(tokens, create_vocab_flag)
     else:
         raise NotImplementedError
 
 
-def tokenize_to_sentences(text, max_sentlength, create_vocab_flag=False):
-    """将长文本分割成句子"""
-    # tokenize a long text to a list of sentences
+def split_sentences(text):
+    """将已标记化的文本（标记以空格连接）按句子切分，返回句子字符串列表"""
     sents = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\!|\?)\s', text)
 
     # Note
@@ -242,6 +460,64 @@ def tokenize_to_sentences(text, max_sentlength, create_vocab_flag=False):
             processed_sents.extend(ssL)
         else:
             processed_sents.append(sent)
+    return processed_sents
+
+
+# 对已标记文本再次分词时仍会生效的规则
+_symbol_regex = re.compile(r'[;@#$%&]')
+_final_period_regex = re.compile(r'([^\.])(\.)([\]\)}>"\'\u00bb\u201d\u2019 ]*)\s*$')
+
+
+def split_pretokenized(sent):
+    """
+    切分已标记化的句子，近似于对该句再次调用word_tokenize（旧流程tokenize_to_sentences）。
+
+    已标记文本按空格切分后，只应用以下仍会改变结果的规则：'@'等符号被单独拆出，句末标记的句号被拆开，
+    非句首的''被视为起始引号``。word_tokenize还会先用punkt对该句再次分句，并拆开每个子句末尾的句号；
+    这里不再分句，因此句号与引号或缩写相连的句子（如 Mr. 、." ）可能与旧流程不同，
+    差异的比例可用benchmark.py tokenize在实际数据上统计。
+    """
+    tokens = []
+    for token in sent.split():
+        if _symbol_regex.search(token):
+            tokens.extend(_symbol_regex.sub(r' \g<0> ', token).split())
+        else:
+            tokens.append(token)
+    if tokens:
+        tokens[-1:] = _final_period_regex.sub(r'\1 \2 \3 ', tokens[-1]).split()
+    for index in range(1, len(tokens)):
+        if tokens[index] == "''":
+            tokens[index] = '``'
+    return tokens
+
+
+def essay_tokens_to_sentences(tokens, create_vocab_flag=False):
+    """
+    将整篇作文的标记列表切分为句子。默认使用旧流程：拼回字符串后分句并逐句重新分词（tokenize_to_sentences）；
+    set_single_pass_tokenization(True)后直接在标记列表上分句和截断（tokens_to_sentences）。
+    """
+    if SINGLE_PASS_TOKENIZATION:
+        return tokens_to_sentences(tokens, MAX_SENTLEN, create_vocab_flag)
+    return tokenize_to_sentences(" ".join(tokens), MAX_SENTLEN, create_vocab_flag)
+
+
+def tokens_to_sentences(tokens, max_sentlength, create_vocab_flag=False):
+    """将整篇作文的标记列表切分为句子，并将过长的句子截断为不超过max_sentlength的多句"""
+    processed_sents = split_sentences(" ".join(tokens))
+
+    if create_vocab_flag:
+        return [w for sent in processed_sents for w in merge_at_tokens(split_pretokenized(sent))]
+    # 处理句子长度
+    sent_tokens = []
+    for sent in processed_sents:
+        sent_tokens.extend(shorten_tokens(split_pretokenized(sent), max_sentlength))
+    return sent_tokens
+
+
+def tokenize_to_sentences(text, max_sentlength, create_vocab_flag=False):
+    """将长文本分割成句子，并逐句重新分词（默认的标记化流程，见essay_tokens_to_sentences）"""
+    # tokenize a long text to a list of sentences
+    processed_sents = split_sentences(text)
 
     if create_vocab_flag:
         sent_tokens = [tokenize(sent) for sent in processed_sents]
@@ -260,11 +536,14 @@ def tokenize_to_sentences(text, max_sentlength, create_vocab_flag=False):
 
 
 def shorten_sentence(sent, max_sentlen):
-    """处理TSV文件中的作文，将其转换为模型输入格式"""
+    """对句子字符串标记化，并将过长的句子截断为不超过max_sentlen的多句"""
+    return shorten_tokens(word_tokenize(sent.strip()), max_sentlen)
+
+
+def shorten_tokens(tokens, max_sentlen):
+    """将过长的句子标记列表截断为不超过max_sentlen的多句"""
     # handling extra long sentence, truncate to no more extra max_sentlen
     new_tokens = []
-    sent = sent.strip()
-    tokens = nltk.word_tokenize(sent)
     if len(tokens) > max_sentlen:
         # print len(tokens)
         # Step 1: split sentence based on keywords
@@ -304,7 +583,7 @@ def shorten_sentence(sent, max_sentlen):
     return new_tokens
 
 
-def read_dataset(file_path, prompt_id, vocab, to_lower, score_index=6, char_level=False):
+def read_dataset(file_path, prompt_id, vocab, to_lower, score_index=6, char_level=False, num_workers=1, cache_dir=None):
     """
        读取数据集文件，将文本和分数转换为模型的输入格式。
 
@@ -315,6 +594,8 @@ def read_dataset(file_path, prompt_id, vocab, to_lower, score_index=6, char_leve
        - to_lower: 是否将文本转换为小写
        - score_index: 在数据文件中，分数位于第几列（默认是第6列）
        - char_level: 是否按字符级别处理文本（暂未实现）
+       - num_workers: 标记化使用的进程数，大于1时并行处理
+       - cache_dir: 标记化缓存目录，为None时不使用缓存
 
        返回：
        - data_x: 转换为索引的文本数据
@@ -325,59 +606,37 @@ def read_dataset(file_path, prompt_id, vocab, to_lower, score_index=6, char_leve
     """
     logger.info('Reading dataset from: ' + file_path)
 
+    vocab = Vocab.from_dict(vocab)
     data_x, data_y, prompt_ids = [], [], []
     num_hit, unk_hit, total = 0., 0., 0.
     max_sentnum = -1
     max_sentlen = -1
-    with codecs.open(file_path, mode='r', encoding='UTF8') as input_file:
-        #input_file.next()
-        #input_file.readline()
-        for line in input_file:
-            tokens = line.strip().split('\t')
-            essay_id = int(tokens[0])
-            essay_set = int(tokens[1])
-            content = tokens[2].strip()
-            score = float(tokens[score_index])
-            if essay_set == prompt_id or prompt_id <= 0:
-            #if  essay_set == prompt_id and score >=high_score[essay_set]:
-                # tokenize text into sentences
-                sent_tokens = text_tokenizer(content, replace_url_flag=True, tokenize_sent_flag=True)
-                if to_lower:
-                    sent_tokens = [[w.lower() for w in s] for s in sent_tokens]
-                if char_level:
-                    raise NotImplementedError
-                sent_indices = []
-                indices = []
-                if char_level:
-                    raise NotImplementedError
-                else:
-                    for sent in sent_tokens:
-                        length = len(sent)
-                        if max_sentlen < length:
-                            max_sentlen = length
-                        for word in sent:
-                            if is_number(word):
-                                indices.append(vocab['<num>'])
-                                num_hit += 1
-                            elif word in vocab:
-                                indices.append(vocab[word])
-                            else:
-                                indices.append(vocab['<unk>'])
-                                unk_hit += 1
-                            total += 1
-                        sent_indices.append(indices)
-                        indices = []
-                data_x.append(sent_indices)
-                data_y.append(score)
-                prompt_ids.append(essay_set)
-
-                if max_sentnum < len(sent_indices):
-                    max_sentnum = len(sent_indices)
+    # tokenize text into sentences
+    rows, essays_tokens = load_tokenized_essays(file_path, prompt_id, to_lower, score_index=score_index,
+                                                num_workers=num_workers, cache_dir=cache_dir)
+    for (essay_id, essay_set, content, score), sent_tokens in zip(rows, essays_tokens):
+        if char_level:
+            raise NotImplementedError
+        sent_indices, essay_num_hit, essay_unk_hit = vocab.encode(sent_tokens)
+        num_hit += essay_num_hit
+        unk_hit += essay_unk_hit
+        for indices in sent_indices:
+            length = len(indices)
+            total += length
+            if max_sentlen < length:
+                max_sentlen = length
+        data_x.append(sent_indices)
+        data_y.append(score)
+        prompt_ids.append(essay_set)
+
+        if max_sentnum < len(sent_indices):
+            max_sentnum = len(sent_indices)
     logger.info('  <num> hit rate: %.2f%%, <unk> hit rate: %.2f%%' % (100*num_hit/total, 100*unk_hit/total))
     return data_x, data_y, prompt_ids, max_sentlen, max_sentnum
 
 
-def get_data(paths, prompt_id, vocab, tokenize_text=True, to_lower=True, sort_by_len=False,  score_index=6):
+def get_data(paths, prompt_id, vocab, tokenize_text=True, to_lower=True, sort_by_len=False,  score_index=6, num_workers=1,
+             cache_dir=None):
     """
         读取训练、验证和测试数据集，并获取最大句子长度和句子数。
 
@@ -389,6 +648,8 @@ def get_data(paths, prompt_id, vocab, tokenize_text=True, to_lower=True, sort_by
         - to_lower: 是否将文本转换为小写
         - sort_by_len: 是否按句子长度排序
         - score_index: 在数据文件中，分数位于第几列（默认是第6列）
+        - num_workers: 标记化使用的进程数
+        - cache_dir: 标记化缓存目录
 
         返回：
         - 训练、验证和测试数据集的文本和分数，以及整体的最大句子长度和句子数
@@ -396,9 +657,9 @@ def get_data(paths, prompt_id, vocab, tokenize_text=True, to_lower=True, sort_by
     train_path, dev_path, test_path = paths[0], paths[1], paths[2]
 
 
-    train_x, train_y, train_prompts, train_maxsentlen, train_maxsentnum = read_dataset(train_path, prompt_id, vocab, to_lower)
-    dev_x, dev_y, dev_prompts, dev_maxsentlen, dev_maxsentnum = read_dataset(dev_path, prompt_id, vocab, to_lower)
-    test_x, test_y, test_prompts, test_maxsentlen, test_maxsentnum = read_dataset(test_path, prompt_id, vocab,  to_lower)
+    train_x, train_y, train_prompts, train_maxsentlen, train_maxsentnum = read_dataset(train_path, prompt_id, vocab, to_lower, num_workers=num_workers, cache_dir=cache_dir)
+    dev_x, dev_y, dev_prompts, dev_maxsentlen, dev_maxsentnum = read_dataset(dev_path, prompt_id, vocab, to_lower, num_workers=num_workers, cache_dir=cache_dir)
+    test_x, test_y, test_prompts, test_maxsentlen, test_maxsentnum = read_dataset(test_path, prompt_id, vocab,  to_lower, num_workers=num_workers, cache_dir=cache_dir)
 
     overal_maxlen = max(train_maxsentlen, dev_maxsentlen, test_maxsentlen)
     overal_maxnum = max(train_maxsentnum, dev_maxsentnum, test_maxsentnum)
@@ -422,6 +683,7 @@ def prompt(file_path, prompt,vocab):
         返回：
         - 对应提示的句子标记索引列表
     """
+    vocab = Vocab.from_dict(vocab)
     indices= []
     with codecs.open(file_path, mode='r', encoding='UTF8') as input_file:
         for line in input_file:
@@ -431,18 +693,14 @@ def prompt(file_path, prompt,vocab):
             if prompt_id  == prompt:
                 sent_tokens = text_tokenizer(content, replace_url_flag=True, tokenize_sent_flag=True)
                 sent_tokens = [[w.lower() for w in s] for s in sent_tokens]
-            for sent in sent_tokens:
-                for word in sent:
-                        if is_number(word):
-                            indices.append(vocab['<num>'])
-                        elif word in vocab:
-                            indices.append(vocab[word])
-                        else:
-                            indices.append(vocab['<unk>'])
+            sent_indices, _, _ = vocab.encode(sent_tokens)
+            for sent in sent_indices:
+                indices.extend(sent)
     return  indices
 
 def prepare_sentence_data(datapaths, vocab,embedding_path=None, embedding='word2vec', embedd_dim=100, prompt_id=1, vocab_size=0, tokenize_text=True, \
-                         to_lower=True, sort_by_len=False, score_index=6,prompt_in_traindata=True):
+                         to_lower=True, sort_by_len=False, score_index=6,prompt_in_traindata=True, num_workers=1,
+                         cache_dir=None, ragged=False):
     """
         准备句子级别的数据集，包括读取数据、标记化、填充序列，以及构建嵌入矩阵。
 
@@ -459,17 +717,27 @@ def prepare_sentence_data(datapaths, vocab,embedding_path=None, embedding='word2
         - sort_by_len: 是否按句子长度排序
         - score_index: 在数据文件中，分数位于第几列（默认是第6列）
         - prompt_in_traindata: 是否在训练数据中包含提示信息
+        - num_workers: 标记化使用的进程数
+        - cache_dir: 标记化缓存目录
+        - ragged: 为True时文本以utils.RaggedEssays返回，不做整体填充，掩码为None
 
         返回：
         - 训练、验证和测试数据集的文本、分数、掩码、提示ID，以及嵌入矩阵、最大句子长度、最大句子数和训练集的平均分数
     """
     assert len(datapaths) == 3, "data paths should include train, dev and test path"
     (train_x, train_y, train_prompts), (dev_x, dev_y, dev_prompts), (test_x, test_y, test_prompts), overal_maxlen, overal_maxnum = \
-        get_data(datapaths, prompt_id, vocab, tokenize_text=True, to_lower=True, sort_by_len=False,  score_index=6)
-
-    X_train, y_train, mask_train = utils.padding_sentence_sequences(train_x, train_y, overal_maxnum, overal_maxlen, post_padding=True)
-    X_dev, y_dev, mask_dev = utils.padding_sentence_sequences(dev_x, dev_y, overal_maxnum, overal_maxlen, post_padding=True)
-    X_test, y_test, mask_test = utils.padding_sentence_sequences(test_x, test_y, overal_maxnum, overal_maxlen, post_padding=True)
+        get_data(datapaths, prompt_id, vocab, tokenize_text=True, to_lower=True, sort_by_len=False,  score_index=6,
+                 num_workers=num_workers, cache_dir=cache_dir)
+
+    if ragged:
+        # 只保存真实的词索引，组批时再填充
+        X_train, y_train, mask_train = utils.RaggedEssays.from_lists(train_x), np.array(train_y, dtype=np.float32).reshape(-1, 1), None
+        X_dev, y_dev, mask_dev = utils.RaggedEssays.from_lists(dev_x), np.array(dev_y, dtype=np.float32).reshape(-1, 1), None
+        X_test, y_test, mask_test = utils.RaggedEssays.from_lists(test_x), np.array(test_y, dtype=np.float32).reshape(-1, 1), None
+    else:
+        X_train, y_train, mask_train = utils.padding_sentence_sequences(train_x, train_y, overal_maxnum, overal_maxlen, post_padding=True, mask_dtype=np.bool_)
+        X_dev, y_dev, mask_dev = utils.padding_sentence_sequences(dev_x, dev_y, overal_maxnum, overal_maxlen, post_padding=True, mask_dtype=np.bool_)
+        X_test, y_test, mask_test = utils.padding_sentence_sequences(test_x, test_y, overal_maxnum, overal_maxlen, post_padding=True, mask_dtype=np.bool_)
 
     if prompt_id:
         train_pmt = np.array(train_prompts, dtype='int32')
@@ -499,9 +767,14 @@ def prepare_sentence_data(datapaths, vocab,embedding_path=None, embedding='word2
 
     logger.info('Statistics:')
 
-    logger.info('  train X shape: ' + str(X_train.shape))
-    logger.info('  dev X shape:   ' + str(X_dev.shape))
-    logger.info('  test X shape:  ' + str(X_test.shape))
+    if ragged:
+        logger.info('  train X: %d essays, %d tokens, %d bytes' % (len(X_train), len(X_train.tokens), X_train.nbytes))
+        logger.info('  dev X:   %d essays, %d tokens, %d bytes' % (len(X_dev), len(X_dev.tokens), X_dev.nbytes))
+        logger.info('  test X:  %d essays, %d tokens, %d bytes' % (len(X_test), len(X_test.tokens), X_test.nbytes))
+    else:
+        logger.info('  train X shape: ' + str(X_train.shape))
+        logger.info('  dev X shape:   ' + str(X_dev.shape))
+        logger.info('  test X shape:  ' + str(X_test.shape))
 
     logger.info('  train Y shape: ' + str(Y_train.shape))
     logger.info('  dev Y shape:   ' + str(Y_dev.shape))
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class SentAttNet(nn.Module):
@@ -23,19 +24,33 @@ class SentAttNet(nn.Module):
         self.fc1 = nn.Linear(sent_hidden_size, sent_hidden_size)
         self.fc2 = nn.Linear(sent_hidden_size, 1, bias=False)
 
-    def forward(self, input):
+    def forward(self, input, lengths=None, pack=True):
         """
         前向传播函数。
 
         :param input: 输入数据，应该是 LSTM 需要的格式
+        :param lengths: 可选，每篇作文的句子数（到最后一个非空句子为止，作文中间的空句子计算在内）；
+            给出时 LSTM 使用打包序列，注意力忽略之后的填充句子
+        :param pack: 是否打包。lengths之后的位置都是填充，单向 LSTM 在之前位置上的输出与是否打包无关，
+            不打包时张量形状与数据无关，便于导出
         :return: 模型输出
         """
-        # 通过 LSTM 层
-        f_output, _ = self.LSTM(input)
+        if lengths is None or not pack:
+            # 通过 LSTM 层
+            f_output, _ = self.LSTM(input)
+        else:
+            # 打包后 LSTM 只计算每篇作文的真实句子
+            packed = pack_padded_sequence(input, lengths.cpu(), enforce_sorted=False)
+            f_output, _ = self.LSTM(packed)
+            f_output, _ = pad_packed_sequence(f_output, total_length=input.size(0))
 
         # 计算注意力权重
         weight = torch.tanh(self.fc1(f_output))
         weight = self.fc2(weight)
+        if lengths is not None:
+            positions = torch.arange(input.size(0), device=input.device).unsqueeze(1)
+            valid = positions < lengths.to(input.device).unsqueeze(0)
+            weight = weight.masked_fill(~valid.unsqueeze(2), float('-inf'))
         weight = F.softmax(weight, dim=0)
 
         # 将注意力权重应用于 LSTM 输出
@@ -3,6 +3,9 @@ import sys
 import argparse
 import random
 import time
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from utils import *  # 导入工具函数
 from metrics import *  # 导入评估指标函数
@@ -15,6 +18,10 @@ import torch.nn as nn
 from torch.utils.data import DataLoader  # 导入数据加载器
 import torch.utils.data as Data  # 导入数据处理工具
 from reader import *  # 导入数据读取函数
+from essay_dataset import RaggedEssayDataset, BucketBatchSampler, BatchIterator, dense_essay_shapes, \
+    padding_fraction  # 导入不规则作文数据集、分桶采样与批迭代器
+from vocab import Vocab  # 导入冻结词汇表
+from checkpoint import CheckpointWriter, model_state, get_rng_state, set_rng_state  # 导入检查点工具
 
 # 初始化日志记录器
 logger = get_logger("Train sentence sequences Recurrent Convolutional model (LSTM stack over CNN)")
@@ -23,11 +30,283 @@ logger = get_logger("Train sentence sequences Recurrent Convolutional model (LST
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
+def train_fold(args, fold):
+    """
+    训练并评估一折数据，开发集QWK最好的模型保存为model_dir下的net_fold{折号}.pt（用checkpoint.load_model加载），
+    每轮结束时的训练状态保存为checkpoint_fold{折号}.pt，--resume时从中继续。
+
+    :return: 开发集QWK最好时测试集的(QWK, Pearson, Spearman)
+    """
+    # 选择分词后端和标记化流程（并行运行时每个进程都需要设置）
+    if args.tokenizer:
+        set_tokenizer_backend(args.tokenizer)
+    set_single_pass_tokenization(args.single_pass_tokenize)
+
+    # 每折单独设置torch（包括CUDA）、numpy和random的随机种子，串行和并行运行时每折的结果相同：
+    # numpy用于OOV词向量的初始化和BucketBatchSampler的打乱
+    random.seed(123 + fold)
+    np.random.seed(123 + fold)
+    torch.manual_seed(123 + fold)
+
+    # 已经完成的折直接返回保存的结果
+    checkpoint_path = os.path.join(args.model_dir, 'checkpoint_fold%d.pt' % fold)
+    resume = None
+    if args.resume and os.path.exists(checkpoint_path):
+        resume = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+        if resume['finished']:
+            _, q3, p3, s3, prompt_results = resume['best_result']
+            print("fold {} already finished, best result Epoch : {},quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
+                fold, resume['best_epoch'], q3, p3, s3))
+            return q3, p3, s3, prompt_results
+
+    # 获取训练参数
+    batch_size = args.batch_size
+
+    # 构建训练、开发和测试数据的路径
+    datapaths = [args.datapath + str(fold) + '/train.tsv', args.datapath + str(fold) + '/dev.tsv', args.datapath + str(fold) + '/test.tsv']
+
+    # 获取嵌入路径、OOV策略、嵌入类型、嵌入维度和提示ID
+    embedding_path = args.embedding_dict
+    oov = args.oov
+    embedding = args.embedding
+    embedd_dim = args.embedding_dim
+    prompt_id = args.prompt_id
+
+    # 创建词汇表
+    vocab = Vocab.from_dict(create_vocab(datapaths[0], prompt_id, 0, True, True, num_workers=args.tokenize_workers,
+                                         cache_dir=args.token_cache_dir), tokenization_settings())
+    if args.vocab_dir:
+        # 保存为二进制词表文件，评分进程可用load_vocab直接加载
+        os.makedirs(args.vocab_dir, exist_ok=True)
+        vocab.save(os.path.join(args.vocab_dir, 'vocab_fold%d.bin' % fold))
+
+    # 准备训练、开发和测试数据
+    (X_train, Y_train, mask_train, train_pmt), (X_dev, Y_dev, mask_dev, dev_pmt), (X_test, Y_test, mask_test, test_pmt), \
+    embed_table, overal_maxlen, overal_maxnum, init_mean_value = prepare_sentence_data(datapaths, vocab, \
+                embedding_path, embedding, embedd_dim, prompt_id, tokenize_text=True, \
+                to_lower=True, sort_by_len=False, score_index=6, num_workers=args.tokenize_workers,
+                cache_dir=args.token_cache_dir, ragged=args.ragged)
+
+    # 获取句子和单词的最大长度
+    max_sentnum = overal_maxnum
+    max_sentlen = overal_maxlen
+
+    # 构建数据集和数据加载器
+    if args.ragged:
+        train_data = RaggedEssayDataset(X_train, Y_train)
+        dev_data = RaggedEssayDataset(X_dev, Y_dev, prompt_ids=dev_pmt)
+        test_data = RaggedEssayDataset(X_test, Y_test, prompt_ids=test_pmt)
+        shapes = X_train.essay_shapes(), X_dev.essay_shapes(), X_test.essay_shapes()
+    else:
+        # 将数据转换为张量
+        train_data = Data.TensorDataset(torch.LongTensor(X_train), torch.tensor(Y_train))
+        # 开发集和测试集附带每篇作文的提示ID，评估时按提示还原分数
+        dev_data = Data.TensorDataset(torch.LongTensor(X_dev), torch.tensor(Y_dev), torch.LongTensor(dev_pmt))
+        test_data = Data.TensorDataset(torch.LongTensor(X_test), torch.tensor(Y_test), torch.LongTensor(test_pmt))
+        shapes = dense_essay_shapes(X_train), dense_essay_shapes(X_dev), dense_essay_shapes(X_test)
+    if args.bucket:
+        # 训练集在分组内随机化，开发集和测试集按长度排序
+        samplers = [BucketBatchSampler(shape[0], batch_size, shuffle, args.bucket_size)
+                    for shape, shuffle in zip(shapes, (True, False, False))]
+        # 每批裁剪到本批的最大句子数和句子长度
+        train_loader, dev_loader, test_loader = [
+            BatchIterator(data, batch_size, batch_sampler=sampler, trim=True, prefetch=args.prefetch,
+                          pin_memory=args.pin_memory)
+            for data, sampler in zip((train_data, dev_data, test_data), samplers)]
+        for name, shape, sampler in zip(('train', 'dev', 'test'), shapes, samplers):
+            # 不分桶时的随机批次，使用独立的随机数生成器以免影响训练的随机性
+            order = np.random.RandomState(0).permutation(len(shape[0]))
+            random_batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+            full = 1. - float(shape[2].sum()) / (len(shape[0]) * max_sentnum * max(max_sentlen, 5))
+            logger.info('%s padding fraction: global %.2f%%, per batch %.2f%%, bucketed %.2f%%'
+                        % (name, 100 * full, 100 * padding_fraction(shape, random_batches),
+                           100 * padding_fraction(shape, sampler.batches())))
+    else:
+        # 进程内按批切片，开发集和测试集不需要打乱
+        train_loader, dev_loader, test_loader = [
+            BatchIterator(data, batch_size, shuffle=shuffle, prefetch=args.prefetch, pin_memory=args.pin_memory)
+            for data, shuffle in zip((train_data, dev_data, test_data), (True, False, False))]
+
+    # 初始化模型
+    model = HierAttNet(100, 100, 10, embed_table, max_sentnum, max_sentlen, "connector_dict.json", vocab=vocab,
+                       masked=args.masked, autocast_dtype=torch.bfloat16 if args.bf16 else None,
+                       checkpoint_activations=args.checkpoint_activations, connector_weighting=args.connector_weighting)
+    # 加载衔接词权重
+    model.load_connector_weights()
+    model.word_att_net.lookup.weight.requires_grad = True
+
+    # 将模型移动到GPU（如果可用）
+    if torch.cuda.is_available():
+        model.cuda()
+
+    print(model)
+
+    # 定义损失函数和优化器
+    criterion = nn.MSELoss()
+    optimizer = build_optimizer(model, args.learning_rate, args.sparse_embedding)
+
+    num_iter_per_epoch = len(train_loader)
+    # 第一次评估的模型总会被记录为最佳
+    best_qwk = float('-inf')
+    best_epoch = 0
+    best_state = None
+    best_result = None
+    bad_evaluations = 0
+    start_epoch = 0
+    model_path = os.path.join(args.model_dir, 'net_fold%d.pt' % fold)
+    if resume is not None:
+        # 恢复模型、优化器、最佳结果和随机数状态，从下一轮继续
+        model.load_state_dict(resume['model'])
+        optimizer.load_state_dict(resume['optimizer'])
+        start_epoch = resume['epoch']
+        best_qwk, best_epoch, bad_evaluations = resume['best_qwk'], resume['best_epoch'], resume['bad_evaluations']
+        best_result, best_state = resume['best_result'], resume['best_state']
+        set_rng_state(resume['rng'])
+        print("resume fold {} from epoch {}".format(fold, start_epoch + 1))
+    writer = CheckpointWriter()
+
+    def save_checkpoint(epoch, finished=False):
+        """在后台线程中写入训练状态，epoch为已完成的轮数"""
+        writer.save({'fold': fold, 'epoch': epoch, 'finished': finished, 'model': model.state_dict(),
+                     'optimizer': optimizer.state_dict(), 'rng': get_rng_state(), 'best_qwk': best_qwk,
+                     'best_epoch': best_epoch, 'bad_evaluations': bad_evaluations, 'best_result': best_result,
+                     'best_state': best_state}, checkpoint_path)
+
+    model.train()
+    # 恢复时所有轮次可能都已完成，只剩测试
+    epoch, iter = start_epoch - 1, num_iter_per_epoch - 1
+
+    # 开始训练循环
+    for epoch in range(start_epoch, args.num_epochs):
+        print("begin train")
+        for iter, (feature, label) in enumerate(train_loader):
+            if torch.cuda.is_available():
+                feature = feature.cuda(non_blocking=True)
+                label = label.cuda(non_blocking=True)
+            optimizer.zero_grad()
+            predictions = model(feature)
+            loss = criterion(predictions, label)
+            loss.backward()
+            optimizer.step()
+
+        print("loss:", loss)
+
+        # 每eval_every轮和最后一轮在开发集上评估
+        if (epoch + 1) % args.eval_every and epoch + 1 < args.num_epochs:
+            save_checkpoint(epoch + 1)
+            continue
+        dev_loss, q1, p1, s1, dev_prompt_results = evaluate(model, dev_loader, criterion)
+        print(
+            "dev  Epoch: {}/{}, Iteration: {}/{}, loss : {}, quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
+                epoch + 1, args.num_epochs, iter + 1, num_iter_per_epoch, dev_loss, q1, p1, s1))
+        print_prompt_results('dev', dev_prompt_results)
+
+        # 在测试集上评估；test_best_only时只在训练结束后评估开发集上最好的模型
+        if not args.test_best_only:
+            result = evaluate(model, test_loader, criterion)
+            print_test_result(epoch + 1, args.num_epochs, iter + 1, num_iter_per_epoch, result)
+
+        # 保存最佳模型
+        if best_epoch == 0 or q1 > best_qwk:
+            best_qwk = q1
+            best_epoch = epoch + 1
+            bad_evaluations = 0
+            writer.save(model_state(model, tokenization_settings()), model_path)
+            if args.test_best_only:
+                best_state = copy.deepcopy(model.state_dict())
+            else:
+                best_result = result
+                print("best result Epoch : {},quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
+                    epoch + 1, result[1], result[2], result[3]))
+        else:
+            bad_evaluations += 1
+        model.train()
+        save_checkpoint(epoch + 1)
+
+        # 开发集QWK连续patience次评估没有提高时提前停止
+        if args.patience and bad_evaluations >= args.patience:
+            print("early stopping at epoch {}: dev quadratic_weighted_kappa has not improved for {} evaluations".format(
+                epoch + 1, bad_evaluations))
+            break
+
+    if args.test_best_only:
+        model.load_state_dict(best_state)
+        best_result = evaluate(model, test_loader, criterion)
+        print_test_result(best_epoch, args.num_epochs, iter + 1, num_iter_per_epoch, best_result)
+    save_checkpoint(epoch + 1, finished=True)
+    writer.close()
+    _, q3, p3, s3, prompt_results = best_result
+    print("fold {} best result Epoch : {},quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
+        fold, best_epoch, q3, p3, s3))
+    return q3, p3, s3, prompt_results
+
+
+def evaluate(model, loader, criterion):
+    """
+    在开发集或测试集上评估模型，评估后模型处于eval模式。loader的每批为(词索引, 原始分数, 提示ID)。
+
+    多个提示联合训练时，预测分数按各作文所属提示的分数范围还原，QWK、Pearson和Spearman按提示分别计算后取平均。
+
+    :return: (加权总损失, QWK, Pearson, Spearman, {提示ID: (QWK, Pearson, Spearman)})
+    """
+    model.eval()
+    loss_ls = []
+    te_label_ls = []
+    te_pred_ls = []
+    te_prompt_ls = []
+    for te_feature, te_label, te_prompt in loader:
+        num_sample = len(te_label)
+        if torch.cuda.is_available():
+            te_feature = te_feature.cuda()
+            te_label = te_label.cuda()
+        with torch.no_grad():
+            te_predictions = model(te_feature)
+            te_loss = criterion(te_predictions, te_label)
+        loss_ls.append(te_loss * num_sample)
+        te_label_ls.extend(te_label.clone().cpu())
+        te_pred_ls.extend(te_predictions.clone().cpu())
+        te_prompt_ls.append(te_prompt.numpy())
+
+    te_label = np.array(te_label_ls)
+    te_prompt = np.concatenate(te_prompt_ls)
+    predictions = convert_to_dataset_friendly_scores(np.array(te_pred_ls), te_prompt)
+    prompt_results = {}
+    for prompt in np.unique(te_prompt):
+        selected = te_prompt == prompt
+        prompt_results[int(prompt)] = (quadratic_weighted_kappa(predictions[selected], te_label[selected]),
+                                       pearson(predictions[selected], te_label[selected]),
+                                       spearman(predictions[selected], te_label[selected]))
+    q, p, s = [np.mean([result[i] for result in prompt_results.values()]) if len(prompt_results) > 1
+               else list(prompt_results.values())[0][i] for i in range(3)]
+    return sum(loss_ls), q, p, s, prompt_results
+
+
+def print_prompt_results(name, prompt_results):
+    """多个提示联合训练时，输出每个提示的评估结果"""
+    if len(prompt_results) < 2:
+        return
+    for prompt, (q, p, s) in sorted(prompt_results.items()):
+        print("{}  prompt {}: quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(name, prompt, q, p, s))
+
+
+def print_test_result(epoch, num_epochs, iteration, num_iter_per_epoch, result):
+    """输出测试集的评估结果"""
+    print(
+        "test  Epoch: {}/{}, Iteration: {}/{}, loss: {}, quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
+            epoch, num_epochs, iteration, num_iter_per_epoch, *result[:4]))
+    print_prompt_results('test', result[4])
+
+
+def init_fold_worker(num_threads):
+    """并行运行各折时，限制每个进程的计算线程数"""
+    torch.set_num_threads(num_threads)
+
+
 def main():
     # 创建命令行参数解析器
     parser = argparse.ArgumentParser(description="sentence Hi_CNN model")
     parser.add_argument('--embedding', type=str, default='word2vec', help='Word embedding type, word2vec, senna or glove')
-    parser.add_argument('--embedding_dict', type=str, default=None, help='Pretrained embedding path')
+    parser.add_argument('--embedding_dict', type=str, default=None, help='Pretrained embedding path, a text file or a .npy store written by convert_embedding.py')
     parser.add_argument('--embedding_dim', type=int, default=64, help='Only useful when embedding is randomly initialised')
     parser.add_argument('--num_epochs', type=int, default=50, help='number of epochs for training')
     parser.add_argument('--batch_size', type=int, default=10, help='Number of texts in each batch')
@@ -37,174 +316,58 @@ def main():
     parser.add_argument('--learning_rate', type=float, default=0.001, help='Initial learning rate')
     parser.add_argument('--dropout', type=float, default=0.5, help='Dropout rate for layers')
     parser.add_argument('--datapath', type=str, default='data/fold_', help='Base path for data')
-    parser.add_argument('--prompt_id', type=int, default=1, help='Prompt ID of the essay set')
+    parser.add_argument('--prompt_id', type=int, default=1, help='Prompt ID of the essay set, <= 0 to train all prompts jointly')
+    parser.add_argument('--tokenize_workers', type=int, default=1, help='Number of processes used to tokenize essays')
+    parser.add_argument('--tokenizer', choices=['nltk', 'regex'], default=None, help='Word tokenizer backend, nltk if installed by default')
+    parser.add_argument('--single_pass_tokenize', action='store_true',
+                        help='Split sentences on the essay tokens without re-tokenizing each sentence; may differ from the default path')
+    parser.add_argument('--token_cache_dir', type=str, default=None, help='Directory for cached tokenized essays, disabled if not set')
+    parser.add_argument('--ragged', action='store_true', help='Keep essays unpadded and pad each batch to its own maxima, requires --masked')
+    parser.add_argument('--bucket', action='store_true', help='Batch essays of similar sentence counts and trim each batch, requires --masked')
+    parser.add_argument('--bucket_size', type=int, default=50, help='Number of batches sorted together when bucketing')
+    parser.add_argument('--bf16', action='store_true', help='Run the forward pass under bfloat16 autocast')
+    parser.add_argument('--connector_weighting', action='store_true',
+                        help='Scale each sentence by the weight of the connector it starts with')
+    parser.add_argument('--masked', action='store_true', help='Ignore padding in attention and pack the sentence LSTM')
+    parser.add_argument('--checkpoint_activations', action='store_true', help='Recompute word-level and sentence-level activations in backward to save memory')
+    parser.add_argument('--sparse_embedding', action='store_true', help='Use sparse embedding gradients updated by SparseAdam')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of batches prepared ahead on a background thread')
+    parser.add_argument('--pin_memory', action='store_true', help='Put batches in pinned memory for asynchronous copies to the GPU')
+    parser.add_argument('--eval_every', type=int, default=1, help='Evaluate on the dev set every N epochs and after the last epoch')
+    parser.add_argument('--patience', type=int, default=0, help='Stop a fold after N dev evaluations without a better QWK, 0 to disable')
+    parser.add_argument('--test_best_only', action='store_true', help='Score the test set once, for the model that is best on dev')
+    parser.add_argument('--model_dir', type=str, default='.', help='Directory for the best model (net_fold{fold}.pt) and checkpoint of each fold')
+    parser.add_argument('--resume', action='store_true', help='Continue each fold from its checkpoint in model_dir')
+    parser.add_argument('--parallel_folds', type=int, default=1, help='Number of folds trained at the same time in separate processes')
+    parser.add_argument('--fold_threads', type=int, default=0, help='torch CPU threads per fold process, 0 for cores / parallel_folds')
+    parser.add_argument('--vocab_dir', type=str, default=None, help='Directory to save the frozen vocabulary of each fold, disabled if not set')
 
     # 解析命令行参数
     args = parser.parse_args()
-
-    # 设置随机种子，以确保结果的可重复性
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed(123)
+    # 不忽略填充时，卷积窗口和句子级别LSTM会计算填充位置，按批填充会让同一篇作文的分数随同批作文变化，
+    # 也与评分时填充到max_sentnum、max_sentlen不一致
+    if args.ragged and not args.masked:
+        parser.error('--ragged pads each batch to its own maxima and requires --masked')
+    if args.bucket and not args.masked:
+        parser.error('--bucket trims each batch to its own maxima and requires --masked')
+    os.makedirs(args.model_dir, exist_ok=True)
+
+    # 训练多个数据折叠，parallel_folds大于1时各折在独立的进程中同时运行
+    if args.parallel_folds > 1:
+        num_threads = args.fold_threads or max(1, (os.cpu_count() or 1) // args.parallel_folds)
+        with ProcessPoolExecutor(args.parallel_folds, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_fold_worker, initargs=(num_threads,)) as executor:
+            results = list(executor.map(train_fold, [args] * 5, range(5)))
     else:
-        torch.manual_seed(123)
-
-    # 获取训练参数
-    batch_size = args.batch_size
-    num_epochs = args.num_epochs
-    count = []
-
-    # 训练多个数据折叠
-    for epoch in range(5):
-        # 构建训练、开发和测试数据的路径
-        datapaths = [args.datapath + str(epoch) + '/train.tsv', args.datapath + str(epoch) + '/dev.tsv', args.datapath + str(epoch) + '/test.tsv']
-
-        # 获取嵌入路径、OOV策略、嵌入类型、嵌入维度和提示ID
-        embedding_path = args.embedding_dict
-        oov = args.oov
-        embedding = args.embedding
-        embedd_dim = args.embedding_dim
-        prompt_id = args.prompt_id
-
-        # 创建词汇表
-        vocab = create_vocab(datapaths[0], prompt_id, 0, True, True)
-
-        # 准备训练、开发和测试数据
-        (X_train, Y_train, mask_train, train_pmt), (X_dev, Y_dev, mask_dev, dev_pmt), (X_test, Y_test, mask_test, test_pmt), \
-        embed_table, overal_maxlen, overal_maxnum, init_mean_value = prepare_sentence_data(datapaths, vocab, \
-                    embedding_path, embedding, embedd_dim, prompt_id, tokenize_text=True, \
-                    to_lower=True, sort_by_len=False, score_index=6)
-
-        # 获取句子和单词的最大长度
-        max_sentnum = overal_maxnum
-        max_sentlen = overal_maxlen
-
-        # 将数据转换为张量
-        Y_train = torch.tensor(Y_train)
-        Y_dev = torch.tensor(Y_dev)
-        Y_test = torch.tensor(Y_test)
-        X_train = torch.LongTensor(X_train)
-        X_dev = torch.LongTensor(X_dev)
-        X_test = torch.LongTensor(X_test)
-
-        # 构建数据集和数据加载器
-        train_data = Data.TensorDataset(X_train, Y_train)
-        dev_data = Data.TensorDataset(X_dev, Y_dev)
-        test_data = Data.TensorDataset(X_test, Y_test)
-        train_loader = Data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=True, num_workers=3)
-        dev_loader = Data.DataLoader(dataset=dev_data, batch_size=batch_size, shuffle=True, num_workers=3)
-        test_loader = Data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=True, num_workers=3)
-
-        # 初始化模型
-        model = HierAttNet(100, 100, 10, embed_table, max_sentnum, max_sentlen, "connector_dict.json")
-        # 加载衔接词权重
-        model.load_connector_weights()
-        model.word_att_net.lookup.weight.requires_grad = True
-
-        # 将模型移动到GPU（如果可用）
-        if torch.cuda.is_available():
-            model.cuda()
-
-        print(model)
-
-        # 定义损失函数和优化器
-        criterion = nn.MSELoss()
-        optimizer = torch.optim.RMSprop(filter(lambda p: p.requires_grad, model.parameters()), lr=args.learning_rate, alpha=0.9)
-
-        best_loss = 1e5
-        best_epoch = 0
-        model.train()
-        p = 0
-        num_iter_per_epoch = len(train_loader)
-
-        # 开始训练循环
-        for epoch in range(args.num_epochs):
-            print("begin train")
-            for iter, (feature, label) in enumerate(train_loader):
-                if torch.cuda.is_available():
-                    feature = feature.cuda()
-                    label = label.cuda()
-                optimizer.zero_grad()
-                model._init_hidden_state()
-                predictions = model(feature)
-                loss = criterion(predictions, label)
-                loss.backward()
-                optimizer.step()
-
-            print("loss:", loss)
-
-            if epoch >= 0:
-                model.eval()
-                loss_ls = []
-                te_label_ls = []
-                te_pred_ls = []
-
-                # 在开发集上评估
-                for te_feature, te_label in dev_loader:
-                    num_sample = len(te_label)
-                    if torch.cuda.is_available():
-                        te_feature = te_feature.cuda()
-                        te_label = te_label.cuda()
-                    with torch.no_grad():
-                        model._init_hidden_state(num_sample)
-                        te_predictions = model(te_feature)
-                    te_loss = criterion(te_predictions, te_label)
-                    loss_ls.append(te_loss * num_sample)
-                    te_label_ls.extend(te_label.clone().cpu())
-                    te_pred_ls.extend(te_predictions.clone().cpu())
-
-            te_label = np.array(te_label_ls)
-            predictions = convert_to_dataset_friendly_scores(np.array(te_pred_ls), prompt_id)
-            q1 = quadratic_weighted_kappa(predictions, te_label)
-            p1 = pearson(predictions, te_label)
-            s1 = spearman(predictions, te_label)
-
-            print(
-                "dev  Epoch: {}/{}, Iteration: {}/{}, loss : {}, quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
-                    epoch + 1,
-                    args.num_epochs,
-                    iter + 1,
-                    num_iter_per_epoch, sum(loss_ls),
-                    q1, p1, s1))
-
-            loss_ls = []
-            te_label_ls = []
-            te_pred_ls = []
-
-            # 在测试集上评估
-            for te_feature, te_label in test_loader:
-                num_sample = len(te_label)
-                if torch.cuda.is_available():
-                    te_feature = te_feature.cuda()
-                    te_label = te_label.cuda()
-                with torch.no_grad():
-                    model._init_hidden_state(num_sample)
-                    te_predictions = model(te_feature)
-                te_loss = criterion(te_predictions, te_label)
-                loss_ls.append(te_loss * num_sample)
-                te_label_ls.extend(te_label.clone().cpu())
-                te_pred_ls.extend(te_predictions.clone().cpu())
-
-            te_label = np.array(te_label_ls)
-            predictions = convert_to_dataset_friendly_scores(np.array(te_pred_ls), prompt_id)
-            q2 = quadratic_weighted_kappa(predictions, te_label)
-            p2 = pearson(predictions, te_label)
-            s2 = spearman(predictions, te_label)
-
-            print(
-                "test  Epoch: {}/{}, Iteration: {}/{}, loss: {}, quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(
-                    epoch + 1, args.num_epochs, iter + 1, num_iter_per_epoch, sum(loss_ls), q2, s2, p2))
-
-            # 保存最佳模型
-            if q1 > p:
-                p = q1
-                q3 = q2
-                p3 = p2
-                s3 = s2
-                torch.save(model, 'net.pkl')
-                print("best result Epoch : {},quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(epoch + 1, q2, p2,s2))
-            model.train()
-        print("best result Epoch : {},quadratic_weighted_kappa: {}, pearson: {}, spearman: {}".format(epoch + 1, q3, p3,s3))
-        count.append(q3)
+        if args.fold_threads:
+            torch.set_num_threads(args.fold_threads)
+        results = [train_fold(args, fold) for fold in range(5)]
+    count = [result[0] for result in results]
+    # 多个提示联合训练时，输出每个提示在各折上的平均QWK
+    prompts = sorted(results[0][3])
+    if len(prompts) > 1:
+        for prompt in prompts:
+            print('prompt {} mean qwk is '.format(prompt), np.mean([result[3][prompt][0] for result in results]))
     cc = 0
     for i in count:
         cc += i
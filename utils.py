@@ -1,10 +1,11 @@
 import gzip
 import logging
+import os
 import sys
+from itertools import chain
 # from gensim.models.word2vec import Word2Vec
 import numpy as np
 import torch
-from sympy.printing.theanocode import theano
 
 # 定义ASAP评分范围的字典，每个prompt_id对应一个评分范围
 asap_ranges = {
@@ -49,60 +50,142 @@ def get_logger(name, level=logging.INFO, handler=sys.stdout,
     return logger
 
 
-def padding_sentence_sequences(index_sequences, scores, max_sentnum, max_sentlen, post_padding=True):
-    """对句子序列进行填充，使其符合模型输入的尺寸要求"""
-    X = np.empty([len(index_sequences), max_sentnum, max_sentlen], dtype=np.int32)
-    Y = np.empty([len(index_sequences), 1], dtype=np.float32)
-    mask = np.zeros([len(index_sequences), max_sentnum, max_sentlen])
+def group_positions(counts):
+    """返回每个元素在其分组内的位置，如counts=[2, 3]时返回[0, 1, 0, 1, 2]"""
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum(), dtype=np.int64) - np.repeat(starts, counts)
 
-    for i in range(len(index_sequences)):
-        sequence_ids = index_sequences[i]
-        num = len(sequence_ids)
-
-        for j in range(num):
-            word_ids = sequence_ids[j]
-            length = len(word_ids)
-            for k in range(length):
-                wid = word_ids[k]
-                X[i, j, k] = wid
 
-            # 将序列末尾之后的X填充为0
-            X[i, j, length:] = 0
-            # 在掩码中，将有效长度范围内的值设为1
-            mask[i, j, :length] = 1
+def id_dtype(vocab_size):
+    """能容纳大小为vocab_size的词表中所有索引的最小无符号整数类型"""
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
 
-        X[i, num:, :] = 0  # 对未使用的部分进行填充
-        Y[i] = scores[i]
 
-    return X, Y, mask
+def check_id_range(word_ids, dtype):
+    """词索引超出dtype的表示范围时抛出ValueError，避免写入时静默回绕"""
+    if len(word_ids) and np.issubdtype(dtype, np.integer) and int(word_ids.max()) > np.iinfo(dtype).max:
+        raise ValueError('word id %d does not fit in %s, use utils.id_dtype(len(vocab))'
+                         % (int(word_ids.max()), np.dtype(dtype).name))
 
 
-def padding_sequences(word_indices, char_indices, scores, max_sentnum, max_sentlen, maxcharlen, post_padding=True):
-    """对单词和字符索引进行填充，支持字符特征"""
-    X = np.empty([len(word_indices), max_sentnum, max_sentlen], dtype=np.int32)
-    Y = np.empty([len(word_indices), 1], dtype=np.float32)
-    mask = np.zeros([len(word_indices), max_sentnum, max_sentlen], dtype=theano.config.floatX)
+def padding_sentence_sequences(index_sequences, scores, max_sentnum, max_sentlen, post_padding=True,
+                               dtype=np.int32, mask_dtype=np.float64):
+    """
+    对句子序列进行填充，使其符合模型输入的尺寸要求。
 
-    char_X = np.empty([len(char_indices), max_sentnum, max_sentlen, maxcharlen], dtype=np.int32)
+    先把所有句子的词索引展平，再根据每篇作文的句子数和每个句子的长度一次性写入X和mask。
 
-    for i in range(len(word_indices)):
-        sequence_ids = word_indices[i]
-        num = len(sequence_ids)
+    :param dtype: X的数据类型，如np.int32或utils.id_dtype(len(vocab))；词索引超出其范围时抛出ValueError
+    :param mask_dtype: mask的数据类型，如np.float64、np.bool_
+    """
+    num_essays = len(index_sequences)
+    sentnums = np.fromiter(map(len, index_sequences), dtype=np.int64, count=num_essays)
+    sents = list(chain.from_iterable(index_sequences))
+    sent_lens = np.fromiter(map(len, sents), dtype=np.int64, count=len(sents))
+    word_ids = np.fromiter(chain.from_iterable(sents), dtype=np.int64, count=int(sent_lens.sum()))
+    check_id_range(word_ids, dtype)
+
+    # 每个句子所属的作文及其在作文中的位置，每个词在句子中的位置
+    essay_row = np.repeat(np.arange(num_essays), sentnums)
+    sent_pos = group_positions(sentnums)
+    word_pos = group_positions(sent_lens)
+
+    X = np.zeros([num_essays, max_sentnum, max_sentlen], dtype=dtype)
+    X[np.repeat(essay_row, sent_lens), np.repeat(sent_pos, sent_lens), word_pos] = word_ids
+
+    # 在掩码中，将有效长度范围内的值设为1
+    lengths = np.zeros([num_essays, max_sentnum], dtype=np.int64)
+    lengths[essay_row, sent_pos] = sent_lens
+    mask = (np.arange(max_sentlen) < lengths[:, :, None]).astype(mask_dtype)
+
+    Y = np.asarray(scores, dtype=np.float32).reshape(num_essays, 1)
+    return X, Y, mask
 
-        for j in range(num):
-            word_ids = sequence_ids[j]
-            length = len(word_ids)
-            for k in range(length):
-                wid = word_ids[k]
-                X[i, j, k] = wid
 
-            # 将序列末尾之后的X填充为0
-            X[i, j, length:] = 0
-            # 在掩码中，将有效长度范围内的值设为1
-            mask[i, j, :length] = 1
+class RaggedEssays(object):
+    def __init__(self, tokens, sent_lens, essay_sentnums):
+        """
+        紧凑的不规则作文表示（CSR格式）：所有词索引展平为一维数组，
+        sent_offsets[k]:sent_offsets[k+1]为第k个句子的词，essay_offsets[i]:essay_offsets[i+1]为第i篇作文的句子。
+
+        :param tokens: 展平后的词索引
+        :param sent_lens: 每个句子的词数
+        :param essay_sentnums: 每篇作文的句子数
+        """
+        self.tokens = np.asarray(tokens, dtype=np.int32)
+        self.sent_offsets = np.concatenate([[0], np.cumsum(sent_lens, dtype=np.int64)])
+        self.essay_offsets = np.concatenate([[0], np.cumsum(essay_sentnums, dtype=np.int64)])
+
+    @classmethod
+    def from_lists(cls, index_sequences):
+        """由read_dataset返回的嵌套词索引列表构建"""
+        essay_sentnums = [len(essay) for essay in index_sequences]
+        sent_lens = [len(sent) for essay in index_sequences for sent in essay]
+        tokens = np.fromiter((wid for essay in index_sequences for sent in essay for wid in sent),
+                             dtype=np.int32, count=sum(sent_lens))
+        return cls(tokens, sent_lens, essay_sentnums)
+
+    def __len__(self):
+        return len(self.essay_offsets) - 1
+
+    @property
+    def sent_lens(self):
+        return np.diff(self.sent_offsets)
+
+    @property
+    def essay_sentnums(self):
+        return np.diff(self.essay_offsets)
+
+    @property
+    def nbytes(self):
+        return self.tokens.nbytes + self.sent_offsets.nbytes + self.essay_offsets.nbytes
+
+    def essay_shapes(self):
+        """返回每篇作文的(句子数, 最长句子的词数, 总词数)"""
+        sentnums = self.essay_sentnums
+        sent_lens = self.sent_lens
+        max_sentlens = np.zeros(len(self), dtype=np.int64)
+        num_tokens = np.zeros(len(self), dtype=np.int64)
+        nonempty = sentnums > 0
+        if len(sent_lens):
+            starts = self.essay_offsets[:-1][nonempty]
+            max_sentlens[nonempty] = np.maximum.reduceat(sent_lens, starts)
+            num_tokens[nonempty] = np.add.reduceat(sent_lens, starts)
+        return sentnums, max_sentlens, num_tokens
+
+    def to_dense(self, indices, min_sentnum=1, min_sentlen=1, dtype=np.int64):
+        """
+        将指定的作文填充为(len(indices), max_sentnum, max_sentlen)的稠密数组，
+        其中max_sentnum和max_sentlen为这些作文自身的最大值（不小于min_sentnum、min_sentlen）。
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        sent_starts = self.essay_offsets[indices]
+        sentnums = self.essay_offsets[indices + 1] - sent_starts
+        # 被选中作文的所有句子在全局句子数组中的位置，以及句子在各自作文中的位置
+        sent_pos = group_positions(sentnums)
+        sent_index = np.repeat(sent_starts, sentnums) + sent_pos
+        sent_lens = self.sent_offsets[sent_index + 1] - self.sent_offsets[sent_index]
+        max_sentnum = max(int(sentnums.max()) if len(sentnums) else 0, min_sentnum)
+        max_sentlen = max(int(sent_lens.max()) if len(sent_lens) else 0, min_sentlen)
+
+        word_pos = group_positions(sent_lens)
+        token_index = np.repeat(self.sent_offsets[sent_index], sent_lens) + word_pos
+        essay_row = np.repeat(np.arange(len(indices)), sentnums)
+        word_ids = self.tokens[token_index]
+        check_id_range(word_ids, dtype)
+        X = np.zeros([len(indices), max_sentnum, max_sentlen], dtype=dtype)
+        X[np.repeat(essay_row, sent_lens), np.repeat(sent_pos, sent_lens), word_pos] = word_ids
+        return X
+
+
+def padding_sequences(word_indices, char_indices, scores, max_sentnum, max_sentlen, maxcharlen, post_padding=True,
+                      mask_dtype=np.float64):
+    """对单词和字符索引进行填充，支持字符特征"""
+    X, Y, mask = padding_sentence_sequences(word_indices, scores, max_sentnum, max_sentlen, post_padding,
+                                            mask_dtype=mask_dtype)
 
-        X[i, num:, :] = 0  # 对未使用的部分进行填充
-        Y[i] = scores[i]
+    char_X = np.empty([len(char_indices), max_sentnum, max_sentlen, maxcharlen], dtype=np.int32)
 
     # 对字符索引进行类似的填充
     for i in range(len(char_indices)):
@@ -128,51 +211,143 @@ def load_word_embedding_dict(embedding, embedding_path, word_alphabet, logger, e
     """
     从文件加载词嵌入
     :param embedding: 嵌入类型（如glove, senna）
-    :param embedding_path: 嵌入文件的路径
+    :param embedding_path: 嵌入文件的路径，也可以是convert_embedding_store生成的.npy存储
+    :param word_alphabet: 词汇表，文本文件只保留其中的词（不区分大小写）；为None时保留全部
     :param logger: 日志记录器
     :return: 词嵌入字典, 嵌入维度, 是否大小写敏感
     """
+    if is_embedding_store(embedding_path):
+        # convert_embedding_store生成的二进制存储，与嵌入类型无关
+        logger.info("Loading embedding store %s ..." % embedding_path)
+        embedd_dict = EmbeddingStore.load(embedding_path)
+        return embedd_dict, embedd_dict.embedd_dim, True
+    if embedding not in ('glove', 'senna'):
+        raise ValueError("embedding should choose from [glove, senna]")
+    logger.info("Loading %s ..." % ('GloVe' if embedding == 'glove' else 'Senna'))
+    # 与build_embedd_table(caseless=True)一致，按小写形式匹配
+    wanted = None if word_alphabet is None else set(word.lower() for word in word_alphabet.keys())
+    embedd_dim = -1
+    matrix, word2row = None, dict()
+    num_lines = 0
+    for word, values in iter_embedding_lines(embedding, embedding_path):
+        num_lines += 1
+        if embedd_dim < 0:
+            embedd_dim = len(values.split())
+            # 预分配连续的float32矩阵，行数不超过词表大小；不过滤时按需扩容
+            matrix = np.empty([len(wanted) if wanted is not None else 1024, embedd_dim], dtype=np.float32)
+        if wanted is not None and word not in wanted:
+            continue
+        values = values.split()
+        assert (embedd_dim == len(values))
+        # 重复的词以最后一次出现为准
+        row = word2row.setdefault(word, len(word2row))
+        if row == matrix.shape[0]:
+            matrix = np.resize(matrix, [2 * matrix.shape[0], embedd_dim])
+        matrix[row] = values
+    if matrix is None:
+        matrix = np.empty([0, max(embedd_dim, 0)], dtype=np.float32)
+    if wanted is not None:
+        logger.info("Kept %d of %d embedding vectors, %d of %d vocabulary words not found (%.2f%%)"
+                    % (len(word2row), num_lines, len(wanted) - len(word2row), len(wanted),
+                       100. * (len(wanted) - len(word2row)) / max(len(wanted), 1)))
+    return EmbeddingStore(matrix[:len(word2row)], word2row), embedd_dim, True
+
+
+# 二进制嵌入存储：<名称>.npy保存float32嵌入矩阵，<名称>.words按行保存对应的词
+EMBEDDING_STORE_SUFFIX = '.npy'
+
+
+def embedding_words_path(store_path):
+    """返回嵌入存储的词索引文件路径"""
+    return store_path[:-len(EMBEDDING_STORE_SUFFIX)] + '.words'
+
+
+def is_embedding_store(embedding_path):
+    """判断路径是否为convert_embedding_store生成的二进制嵌入存储"""
+    return embedding_path.endswith(EMBEDDING_STORE_SUFFIX) and os.path.exists(embedding_words_path(embedding_path))
+
+
+def iter_embedding_lines(embedding, embedding_path):
+    """逐行读取文本格式的嵌入文件，产出(词, 未切分的向量字符串)，只有需要的行才做切分和数值转换"""
     if embedding == 'glove':
-        # 加载GloVe嵌入
-        logger.info("Loading GloVe ...")
-        embedd_dim = -1
-        embedd_dict = dict()
-        with open(embedding_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                tokens = line.split()
-                if embedd_dim < 0:
-                    embedd_dim = len(tokens) - 1
-                else:
-                    assert (embedd_dim + 1 == len(tokens))
-                embedd = np.empty([1, embedd_dim])
-                embedd[:] = tokens[1:]
-                embedd_dict[tokens[0]] = embedd
-        return embedd_dict, embedd_dim, True
+        file = open(embedding_path, 'r', encoding='utf-8')
     elif embedding == 'senna':
-        # 加载Senna嵌入
-        logger.info("Loading Senna ...")
-        embedd_dim = -1
-        embedd_dict = dict()
-        with gzip.open(embedding_path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-
-                tokens = line.split()
-                if embedd_dim < 0:
-                    embedd_dim = len(tokens) - 1
-                else:
-                    assert (embedd_dim + 1 == len(tokens))
-                embedd = np.empty([1, embedd_dim], dtype=theano.config.floatX)
-                embedd[:] = tokens[1:]
-                embedd_dict[tokens[0]] = embedd
-        return embedd_dict, embedd_dim, True
+        file = gzip.open(embedding_path, 'rt', encoding='utf-8')
     else:
         raise ValueError("embedding should choose from [glove, senna]")
+    with file:
+        for line in file:
+            tokens = line.split(None, 1)
+            if len(tokens) == 2:
+                yield tokens[0], tokens[1]
+
+
+def convert_embedding_store(embedding, embedding_path, store_path, logger):
+    """
+    将文本格式的嵌入文件一次性转换为二进制嵌入存储，之后可用EmbeddingStore内存映射加载。
+
+    第一遍只统计行数和维度，第二遍把向量直接写入内存映射的float32矩阵，内存占用与词数无关。
+    :return: 嵌入存储路径
+    """
+    assert store_path.endswith(EMBEDDING_STORE_SUFFIX), "store path should end with " + EMBEDDING_STORE_SUFFIX
+    num_words, embedd_dim = 0, -1
+    for _, values in iter_embedding_lines(embedding, embedding_path):
+        if embedd_dim < 0:
+            embedd_dim = len(values.split())
+        num_words += 1
+    logger.info("Converting %s: %d words, dim %d -> %s" % (embedding_path, num_words, embedd_dim, store_path))
+
+    matrix = np.lib.format.open_memmap(store_path + '.tmp', mode='w+', dtype=np.float32, shape=(num_words, embedd_dim))
+    with open(embedding_words_path(store_path) + '.tmp', 'w', encoding='utf-8') as words_file:
+        for row, (word, values) in enumerate(iter_embedding_lines(embedding, embedding_path)):
+            values = values.split()
+            assert (embedd_dim == len(values))
+            matrix[row] = values
+            words_file.write(word + '\n')
+    matrix.flush()
+    del matrix
+    os.replace(store_path + '.tmp', store_path)
+    os.replace(embedding_words_path(store_path) + '.tmp', embedding_words_path(store_path))
+    return store_path
+
+
+class EmbeddingStore(object):
+    def __init__(self, matrix, word2row):
+        """
+        float32嵌入矩阵加词到行号的索引，可像嵌入字典一样按词取向量。
+
+        :param matrix: 形状为(词数, embedd_dim)的矩阵，可以是内存映射数组
+        :param word2row: {词: 行号}
+        """
+        self.matrix = matrix
+        self.word2row = word2row
+
+    @classmethod
+    def load(cls, store_path):
+        """内存映射方式加载二进制嵌入存储，矩阵本身不读入内存，build_embedd_table只会读取词表中出现的词所在的行"""
+        matrix = np.load(store_path, mmap_mode='r')
+        with open(embedding_words_path(store_path), 'r', encoding='utf-8') as words_file:
+            words = words_file.read().split('\n')[:matrix.shape[0]]
+        # 与文本加载一致，重复的词以最后一次出现为准
+        return cls(matrix, dict(zip(words, range(len(words)))))
+
+    @property
+    def embedd_dim(self):
+        return self.matrix.shape[1]
+
+    def __len__(self):
+        return len(self.word2row)
+
+    def __contains__(self, word):
+        return word in self.word2row
+
+    def __getitem__(self, word):
+        return np.asarray(self.matrix[self.word2row[word]]).reshape(1, -1)
+
+    def gather(self, words):
+        """按词取出多行向量，返回形状为(len(words), embedd_dim)的数组"""
+        rows = np.fromiter((self.word2row[word] for word in words), dtype=np.int64, count=len(words))
+        return self.matrix[rows]
 
 
 def build_embedd_table(word_alphabet, embedd_dict, embedd_dim, logger, caseless):
@@ -180,15 +355,22 @@ def build_embedd_table(word_alphabet, embedd_dict, embedd_dim, logger, caseless)
     scale = np.sqrt(3.0 / embedd_dim)
     embedd_table = np.empty([len(word_alphabet), embedd_dim])
     embedd_table[0, :] = np.zeros([1, embedd_dim])  # 词表中的第一个词通常是填充词，对应全0向量
-    oov_num = 0  # 未登录词的数量
+    hit_indices, hit_words, oov_indices = [], [], []
     for word, index in word_alphabet.items():
         ww = word.lower() if caseless else word  # 根据是否大小写敏感来处理单词
         if ww in embedd_dict:
-            embedd = embedd_dict[ww]
+            hit_indices.append(index)
+            hit_words.append(ww)
+        else:
+            oov_indices.append(index)
+    if hit_words:
+        if isinstance(embedd_dict, EmbeddingStore):
+            embedd_table[hit_indices] = embedd_dict.gather(hit_words)
         else:
-            embedd = np.random.uniform(-scale, scale, [1, embedd_dim])  # 对未登录词生成随机嵌入
-            oov_num += 1
-        embedd_table[index, :] = embedd
+            embedd_table[hit_indices] = np.concatenate([embedd_dict[ww] for ww in hit_words])
+    # 对未登录词生成随机嵌入，一次生成与逐词生成得到的随机数序列相同
+    oov_num = len(oov_indices)  # 未登录词的数量
+    embedd_table[oov_indices] = np.random.uniform(-scale, scale, [oov_num, embedd_dim])
     oov_ratio = float(oov_num) / (len(word_alphabet) - 1)  # 计算未登录词比例
     logger.info("OOV number =%s, OOV ratio = %f" % (oov_num, oov_ratio))
     return embedd_table
@@ -272,3 +454,40 @@ def domain_specific_rescale(y_true, y_pred, set_ids):
                           np.around(y5_pred), np.around(y6_pred), np.around(y7_pred), np.around(y8_pred)]
 
     return prompts_truescores, prompts_predscores
+
+
+class MultiOptimizer(object):
+    def __init__(self, *optimizers):
+        """将多个优化器组合为一个，zero_grad、step和state_dict依次作用于每个优化器"""
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def build_optimizer(model, learning_rate, sparse_embedding=False):
+    """
+    构建训练用的优化器：所有需要梯度的参数使用RMSprop。
+
+    sparse_embedding为True时词嵌入层改为产生稀疏梯度，只更新本批出现的词所在的行，词嵌入使用SparseAdam，
+    其余参数仍使用RMSprop。词表或嵌入维度较大时可以显著减少每步的优化器耗时，见benchmark.py sparse。
+    """
+    lookup = model.word_att_net.lookup
+    if not (sparse_embedding and lookup.weight.requires_grad):
+        return torch.optim.RMSprop(filter(lambda p: p.requires_grad, model.parameters()), lr=learning_rate, alpha=0.9)
+    lookup.sparse = True
+    dense_params = [p for p in model.parameters() if p.requires_grad and p is not lookup.weight]
+    return MultiOptimizer(torch.optim.RMSprop(dense_params, lr=learning_rate, alpha=0.9),
+                          torch.optim.SparseAdam([lookup.weight], lr=learning_rate))
@@ -0,0 +1,130 @@
+import json
+import re
+from itertools import chain, repeat
+import numpy as np
+
+# 正则表达式用于匹配数字
+num_regex = re.compile(r'^[+-]?[0-9]+\.?[0-9]*$')
+
+# 词表文件头，用于识别二进制词表文件
+VOCAB_MAGIC = b'AESVOCAB'
+
+
+class Vocab(object):
+    def __init__(self, words, tokenization=None):
+        """
+        冻结的词汇表，词的编号即其在words中的位置。
+
+        词表中本身是数字的词在查找表中直接指向<num>，因此编码时只有查不到的词才需要做数字判断。
+
+        :param words: 按编号排列的词列表，需包含<pad>、<unk>和<num>
+        :param tokenization: 可选，建立词表时的标记化设置（reader.tokenization_settings），随词表文件保存
+        """
+        self.words = list(words)
+        self.tokenization = tokenization
+        self.word2id = dict((word, index) for index, word in enumerate(self.words))
+        self.pad_id = self.word2id['<pad>']
+        self.unk_id = self.word2id['<unk>']
+        self.num_id = self.word2id['<num>']
+        self._lookup = dict(self.word2id)
+        for word in self.words:
+            if num_regex.match(word):
+                self._lookup[word] = self.num_id
+
+    @classmethod
+    def from_dict(cls, vocab, tokenization=None):
+        """由create_vocab返回的{词: 编号}字典构建，编号必须为0到len(vocab)-1"""
+        if isinstance(vocab, Vocab):
+            return vocab
+        words = [None] * len(vocab)
+        for word, index in vocab.items():
+            words[index] = word
+        assert None not in words, "vocabulary ids should be contiguous"
+        return cls(words, tokenization)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.word2id
+
+    def __getitem__(self, word):
+        return self.word2id[word]
+
+    def get(self, word, default=None):
+        return self.word2id.get(word, default)
+
+    def keys(self):
+        return self.word2id.keys()
+
+    def items(self):
+        return self.word2id.items()
+
+    def encode(self, sentences):
+        """
+        将一篇作文（句子标记列表）一次性转换为词索引，数字映射为<num>，未登录词映射为<unk>。
+
+        :return: (句子索引列表, <num>命中数, <unk>命中数)
+        """
+        words = list(chain.from_iterable(sentences))
+        ids = list(map(self._lookup.get, words, repeat(-1)))
+        unk_hit = 0
+        if -1 in ids:
+            for index, wid in enumerate(ids):
+                if wid < 0:
+                    if num_regex.match(words[index]):
+                        ids[index] = self.num_id
+                    else:
+                        ids[index] = self.unk_id
+                        unk_hit += 1
+        # 文本中字面的<num>不计入数字命中，与逐词判断时一致
+        num_hit = ids.count(self.num_id) - words.count('<num>')
+        sent_indices = []
+        start = 0
+        for sent in sentences:
+            sent_indices.append(ids[start:start + len(sent)])
+            start += len(sent)
+        return sent_indices, num_hit, unk_hit
+
+    def encode_batch(self, essays):
+        """批量编码多篇作文，返回每篇作文的句子索引列表"""
+        return [self.encode(sentences)[0] for sentences in essays]
+
+    def save(self, vocab_path):
+        """
+        保存为二进制文件：文件头、词数、各词在字节块中的偏移（int64），以及UTF-8字节块。
+        有标记化设置时以JSON附在字节块之后，旧版本的文件没有这一部分。
+        """
+        encoded = [word.encode('utf-8') for word in self.words]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in encoded])
+        with open(vocab_path, 'wb') as f:
+            f.write(VOCAB_MAGIC)
+            f.write(np.array([len(encoded)], dtype=np.int64).tobytes())
+            f.write(offsets.tobytes())
+            f.write(b''.join(encoded))
+            if self.tokenization is not None:
+                f.write(json.dumps(self.tokenization).encode('utf-8'))
+
+    @classmethod
+    def load(cls, vocab_path):
+        """
+        读取save保存的词表文件。编码需要完整的词到编号的查找表，因此整个文件一次读入并解码，
+        不使用内存映射；与pickle字典相比省去了反序列化，且不执行文件中的代码。
+        """
+        with open(vocab_path, 'rb') as f:
+            data = f.read()
+        assert data[:len(VOCAB_MAGIC)] == VOCAB_MAGIC, "not a binary vocabulary file: " + vocab_path
+        header = len(VOCAB_MAGIC)
+        num_words = int(np.frombuffer(data, dtype=np.int64, count=1, offset=header)[0])
+        offsets = np.frombuffer(data, dtype=np.int64, count=num_words + 1, offset=header + 8).tolist()
+        blob = data[header + 8 + 8 * (num_words + 1):]
+        metadata = blob[offsets[-1]:]
+        tokenization = json.loads(metadata.decode('utf-8')) if metadata else None
+        return cls([blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(num_words)], tokenization)
+
+    @staticmethod
+    def is_vocab_file(vocab_path):
+        """判断文件是否为save保存的二进制词表"""
+        with open(vocab_path, 'rb') as f:
+            return f.read(len(VOCAB_MAGIC)) == VOCAB_MAGIC
@@ -14,8 +14,8 @@ class WordAttNet(nn.Module):
         """
         super(WordAttNet, self).__init__()
 
-        # 将词典从 NumPy 数组转换为 PyTorch tensor
-        dict = torch.from_numpy(dict.astype(float))
+        # 将词典从 NumPy 数组转换为 float32 的 PyTorch tensor，只转换一次，前向计算时不再复制
+        dict = torch.from_numpy(np.asarray(dict, dtype=np.float32))
         # 创建嵌入层，并加载预训练的词嵌入
         self.lookup = nn.Embedding(num_embeddings=4000, embedding_dim=50).from_pretrained(dict)
 
@@ -29,11 +29,12 @@ class WordAttNet(nn.Module):
         self.fc1 = nn.Linear(100, 100)
         self.fc2 = nn.Linear(100, 1, bias=False)
 
-    def forward(self, input):
+    def forward(self, input, mask=None):
         """
         前向传播函数。
 
         :param input: 输入数据，预期为词索引的 tensor
+        :param mask: 可选，形状为 seq_len * batch 的布尔张量，标记真实的词；给出时注意力只作用于不含填充词的卷积窗口
         :return: 模型输出
         """
         # 查找词嵌入
@@ -46,7 +47,7 @@ class WordAttNet(nn.Module):
         output = output.permute(1, 2, 0)
 
         # 应用卷积层
-        f_output = self.conv1(output.float())  # 形状: batch * hidden_size * seq_len
+        f_output = self.conv1(output)  # 形状: batch * hidden_size * seq_len
 
         # 调整维度
         f_output = f_output.permute(2, 0, 1)  # 形状: seq_len * batch * hidden_size
@@ -54,6 +55,12 @@ class WordAttNet(nn.Module):
         # 计算注意力权重
         weight = torch.tanh(self.fc1(f_output))
         weight = self.fc2(weight)
+        if mask is not None:
+            # 句子的真实长度为n时，前n-4个窗口不含填充词；不足一个窗口时保留第一个窗口
+            lengths = mask.sum(0) - (self.conv1.kernel_size[0] - 1)
+            positions = torch.arange(f_output.size(0), device=input.device).unsqueeze(1)
+            valid = positions < lengths.clamp(min=1).unsqueeze(0)
+            weight = weight.masked_fill(~valid.unsqueeze(2), float('-inf'))
         weight = F.softmax(weight, 0)
 
         # 将注意力权重应用于卷积输出